@@ -0,0 +1,31 @@
+# Loads the plugin against a throwaway SQLite database, outside of supybot-test, for benchmarks.
+import importlib.util
+import os
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def load_plugin(db_path=None):
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='tellbench'), 'tell.db')
+    os.environ['TELL_CONNECTION_STRING'] = 'sqlite:///' + db_path
+    os.environ['IRC_BOT_DEV'] = '1'
+
+    # Registry files, logs etc. go to a scratch directory
+    os.chdir(os.path.dirname(db_path))
+    import supybot.test as test
+    import supybot.conf as conf
+    conf.registerNetwork('test')
+
+    _spec = importlib.util.spec_from_file_location('Tell', os.path.join(ROOT, '__init__.py'),
+                                                   submodule_search_locations=[ROOT])
+    _mod = importlib.util.module_from_spec(_spec)
+    sys.modules['Tell'] = _mod
+    _spec.loader.exec_module(_mod)
+    return _mod, test.getTestIrc()
+
+
+def make_plugin(mod, irc):
+    return mod.Class(irc)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Bytes per cached tell for the old dict based cache vs CachedTell/Mailbox, on a synthetic backlog.
+#
+#   python bench/cache_memory.py [--tells 200000] [--nicks 20000] [--senders 500]
+import argparse
+import datetime
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from local.tell_cache import CachedTell, Mailbox  # noqa: E402
+
+
+# What a DB driver hands back: a fresh str object per row, even for repeated values
+def _fresh(s):
+    return s.encode('utf-8').decode('utf-8')
+
+
+def synthetic_rows(tells, nicks, senders, seed=1):
+    _rand = random.Random(seed)
+    _start = datetime.datetime(2017, 1, 1)
+    for i in range(tells):
+        yield (i + 1,
+               _fresh('nick%d' % _rand.randrange(nicks)),
+               _fresh('sender%d' % _rand.randrange(senders)),
+               _fresh('x' * _rand.randint(10, 200)),
+               _rand.random() < 0.3,
+               _start + datetime.timedelta(seconds=_rand.randrange(10 ** 8)))
+
+
+def build_dicts(rows):
+    _cache = {}
+    for _id, to_nick, from_nick, content, private, ts in rows:
+        _r = {'id': _id, 'content': content, 'time': ts, 'private': private, 'from': from_nick}
+        if to_nick in _cache:
+            _cache[to_nick]['tells'].append(_r)
+        else:
+            _cache[to_nick] = {'tells': [_r], 'delay': None}
+    return _cache
+
+
+def build_slotted(rows):
+    _cache = {}
+    for _id, to_nick, from_nick, content, private, ts in rows:
+        _r = CachedTell.create(_id, content, ts, private, from_nick)
+        if to_nick in _cache:
+            _cache[to_nick].tells.append(_r)
+        else:
+            _cache[to_nick] = Mailbox([_r])
+    return _cache
+
+
+# Bytes the cache keeps alive. Rows are generated inside the traced window and thrown away, like
+# result rows from the DB would be, so everything still allocated afterwards belongs to the cache.
+def measure(build, args):
+    gc.collect()
+    tracemalloc.start()
+    _cache = build(synthetic_rows(args.tells, args.nicks, args.senders))
+    gc.collect()
+    _bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del _cache
+    return _bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes per cached tell, dict vs slotted cache')
+    parser.add_argument('--tells', type=int, default=200000)
+    parser.add_argument('--nicks', type=int, default=20000)
+    parser.add_argument('--senders', type=int, default=500)
+    args = parser.parse_args()
+
+    for name, build in (('dict', build_dicts), ('slotted', build_slotted)):
+        _bytes = measure(build, args)
+        print('%-8s %11d bytes %7.1f bytes/tell' % (name, _bytes, float(_bytes) / args.tells))
+
+
+if __name__ == '__main__':
+    main()
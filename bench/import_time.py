@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Cost of importing the plugin's database module, each run in a fresh interpreter.
+#
+#   python bench/import_time.py [--runs 20] [--url sqlite:////tmp/x.db] [--dev]
+#
+# Reports the median import time, whether the import opened the database (a SQLite file that
+# appeared) and whether it loaded the database driver.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+_SCRIPT = '''
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+_start = time.perf_counter()
+import local.tell_db
+_secs = time.perf_counter() - _start
+print(json.dumps({"seconds": _secs, "modules": len(sys.modules), "driver": "sqlite3" in sys.modules}))
+'''
+
+
+def run(url, dev):
+    _env = dict(os.environ, TELL_CONNECTION_STRING=url, IRC_BOT_DEV='1' if dev else '0')
+    _out = subprocess.check_output([sys.executable, '-c', _SCRIPT, ROOT], env=_env, cwd=tempfile.gettempdir(),
+                                   stderr=subprocess.DEVNULL)
+    # supybot.world logs its shutdown to stdout after we're done
+    return json.loads([line for line in _out.decode().splitlines() if line.startswith('{')][-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import time of local.tell_db')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--url', help='database URL, a fresh SQLite file per run by default')
+    parser.add_argument('--dev', action='store_true', help='set IRC_BOT_DEV=1, which creates the schema')
+    args = parser.parse_args()
+
+    _times = []
+    _connected = 0
+    _driver = 0
+    for _ in range(args.runs):
+        _path = os.path.join(tempfile.mkdtemp(prefix='tellimport'), 'tell.db')
+        _result = run(args.url or 'sqlite:///' + _path, args.dev)
+        _times.append(_result['seconds'])
+        _connected += os.path.exists(_path)
+        _driver += _result['driver']
+
+    print('runs:      %d' % args.runs)
+    print('median:    %.1f ms' % (statistics.median(_times) * 1000))
+    print('min:       %.1f ms' % (min(_times) * 1000))
+    print('connected: %d/%d' % (_connected, args.runs))
+    print('driver:    %d/%d' % (_driver, args.runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Per-message cost of Tell.inFilter for senders without mail, i.e. ordinary busy channel traffic.
+#
+#   python bench/infilter_nomail.py [--messages 200000] [--speakers 500] [--mailboxes 10000]
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _harness import load_plugin, make_plugin  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='inFilter cost per message for nicks without mail')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--speakers', type=int, default=500, help='distinct nicks talking in the channel')
+    parser.add_argument('--mailboxes', type=int, default=10000, help='other nicks with pending tells')
+    args = parser.parse_args()
+
+    mod, irc = load_plugin()
+    import supybot.ircmsgs as ircmsgs
+
+    cb = make_plugin(mod, irc)
+    _now = datetime.datetime.now()
+    for i in range(0, args.mailboxes, 500):
+        cb.queryTell.insert_tells('sender', ['away%d' % n for n in range(i, min(i + 500, args.mailboxes))],
+                                  'hello', False, _now)
+
+    _msgs = [ircmsgs.privmsg('#busy', 'just chatting about things in the channel, nothing special',
+                             prefix='speaker%d!user@host' % (i % args.speakers)) for i in range(args.messages)]
+
+    for lazy in (False, True):
+        cb.queryTell.configure_cache(lazy, 10000, 100000)
+        cb.queryTell.load_unread()
+        # Warm up, lazy mode learns who has no mail on the first pass
+        for m in _msgs[:args.speakers]:
+            cb.inFilter(irc, m)
+
+        _it = iter(_msgs)
+        _secs = timeit.timeit(lambda: cb.inFilter(irc, next(_it)), number=args.messages)
+        print('%-6s %8.0f ns/message' % ('lazy' if lazy else 'eager', _secs / args.messages * 1e9))
+
+
+if __name__ == '__main__':
+    main()
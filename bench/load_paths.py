@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Reading every unread tell into cache entries: ORM objects vs rows streamed through SQLAlchemy Core.
+#
+#   python bench/load_paths.py [--tells 100000] [--nicks 10000] [--repeat 3] [--orm-commit]
+#
+# orm is the old query_unread's ORM query, without its commit. core is TellDB.stream_unread.
+# --orm-commit adds the old query_unread as it was: the commit expires the objects, so every one
+# is loaded again with its own SELECT when its attributes are read. That takes minutes at 100k.
+# Each reports the best time and the peak memory of one traced run.
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _harness import load_plugin  # noqa: E402
+from suite import seed  # noqa: E402
+
+
+def measure(f, repeat):
+    _times = []
+    for _ in range(repeat):
+        gc.collect()
+        _start = time.perf_counter()
+        _count = len(f())
+        _times.append(time.perf_counter() - _start)
+
+    gc.collect()
+    tracemalloc.start()
+    f()
+    _peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return _count, min(_times), _peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='unread tells into the cache, ORM vs Core')
+    parser.add_argument('--tells', type=int, default=100000)
+    parser.add_argument('--nicks', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--orm-commit', action='store_true', help='also run the old path with the commit')
+    args = parser.parse_args()
+
+    load_plugin()
+    from Tell.local import tell_db
+    from Tell.local.tell_cache import CachedTell
+    TellDB = tell_db.TellDB
+    TellRecord = tell_db.TellRecord
+
+    tell_db.migrate()
+    seed(tell_db, args.tells, args.nicks, args.seed)
+
+    def orm(commit):
+        def f():
+            _session = tell_db.session
+            _records = _session.query(TellRecord).filter(TellRecord.Read == 0).all()
+            if commit:
+                _session.commit()
+            _tells = [CachedTell.from_record(r) for r in _records]
+            _session.commit()
+            return _tells
+        return f
+
+    def core():
+        _create = CachedTell.create
+        return [_create(i, content, ts, private, sender)
+                for i, sender, _, content, private, ts, _ in TellDB.stream_unread()]
+
+    print('%-12s %8s %10s %12s' % ('path', 'tells', 'seconds', 'peak MiB'))
+    _paths = [('orm', orm(False), args.repeat), ('core', core, args.repeat)]
+    if args.orm_commit:
+        _paths.insert(0, ('orm_commit', orm(True), 1))
+    for name, f, repeat in _paths:
+        _count, _secs, _peak = measure(f, repeat)
+        print('%-12s %8d %10.3f %12.1f' % (name, _count, _secs, _peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Database size and cache memory for broadcast heavy traffic, with and without normalize.
+#
+#   python bench/normalize.py [--commands 5000] [--recipients 20] [--single 20000] [--normalize]
+#
+# Sends `commands` tells to `recipients` nicks each, plus `single` one-nick tells, with 200
+# character texts. Reports the SQLite file size after VACUUM and the memory load_unread retains.
+import argparse
+import datetime
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _harness import load_plugin, make_plugin  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='storage and memory of broadcast tells')
+    parser.add_argument('--commands', type=int, default=5000, help='tell commands to several nicks')
+    parser.add_argument('--recipients', type=int, default=20, help='nicks per tell command')
+    parser.add_argument('--single', type=int, default=20000, help='tells to a single nick')
+    parser.add_argument('--normalize', action='store_true', help='set plugins.Tell.normalize')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    mod, irc = load_plugin()
+    import supybot.conf as conf
+    from Tell.local.tell_db import TellDB
+    if args.normalize:
+        conf.supybot.plugins.Tell.normalize.setValue(True)
+
+    cb = make_plugin(mod, irc)
+    lib = cb.queryTell
+    _rand = random.Random(args.seed)
+    _now = datetime.datetime.now()
+    for i in range(args.commands):
+        TellDB.insert_tells('sender%d' % (i % 50), ['nick%d' % _rand.randrange(5000) for _ in range(args.recipients)],
+                            '%06d ' % i + 'x' * 193, False, _now - datetime.timedelta(seconds=i))
+    for i in range(args.single):
+        TellDB.insert_tells('sender%d' % (i % 50), ['nick%d' % _rand.randrange(5000)],
+                            '%06d ' % i + 'y' * 193, False, _now - datetime.timedelta(seconds=i))
+    TellDB.compact()
+
+    lib.unread_tells = {}
+    gc.collect()
+    tracemalloc.start()
+    lib.load_unread()
+    gc.collect()
+    _retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    _db = os.environ['TELL_CONNECTION_STRING'][len('sqlite:///'):]
+    print('tells:          %d' % lib.get_tell_count())
+    print('database:       %.1f MiB' % (os.path.getsize(_db) / 2 ** 20))
+    print('cache retained: %.1f MiB' % (_retained / 2 ** 20))
+    print('bytes per tell: %.0f' % (float(_retained) / lib.get_tell_count()))
+    cb.die()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# telllog/tellsearch lookups on a seeded SQLite table: the FTS5 index against a LIKE scan, and
+# keyset pages against OFFSET ones.
+#
+#   python bench/search.py [--tells 200000] [--nicks 2000] [--pages 500]
+#
+# Texts are 12 words out of a 5000 word vocabulary. nick0 gets a fifth of all tells, so its
+# history is deep enough for paging to matter.
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _harness import load_plugin  # noqa: E402
+
+WORDS = ['word%d' % i for i in range(5000)]
+
+
+def best(f, repeat=5):
+    _times = []
+    for _ in range(repeat):
+        _start = time.perf_counter()
+        _result = f()
+        _times.append(time.perf_counter() - _start)
+    return min(_times), _result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tell history search, full text index vs LIKE')
+    parser.add_argument('--tells', type=int, default=200000)
+    parser.add_argument('--nicks', type=int, default=2000)
+    parser.add_argument('--pages', type=int, default=500, help='page the deep page lookups start at')
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    load_plugin()
+    from Tell.local import tell_db
+    from sqlalchemy import and_, select, func
+    TellDB = tell_db.TellDB
+    TellRecord = tell_db.TellRecord
+    tell_db.migrate()
+
+    _rand = random.Random(args.seed)
+    _start = datetime.datetime(2020, 1, 1)
+    _rows = []
+    for i in range(args.tells):
+        _to = 'nick0' if _rand.random() < 0.2 else 'nick%d' % _rand.randrange(args.nicks)
+        _from = 'nick%d' % _rand.randrange(args.nicks)
+        _rows.append({'FromNick': _from, 'FromNickKey': _from, 'ToNick': _to, 'ToNickKey': _to,
+                      'Content': ' '.join(_rand.choice(WORDS) for _ in range(12)),
+                      'Private': False, 'Read': True, 'Timestamp': _start + datetime.timedelta(minutes=i)})
+    with tell_db.get_engine().begin() as conn:
+        for i in range(0, len(_rows), 10000):
+            conn.execute(TellRecord.__table__.insert(), _rows[i:i + 10000])
+
+    _size = args.page_size
+    _words = ['word17', 'word4242']
+
+    # Newest tells with both words over the whole table
+    def all_nicks(match):
+        def f():
+            _query = select(TellRecord.ID).select_from(tell_db._tell_join()) \
+                .order_by(TellRecord.Timestamp.desc(), TellRecord.ID.desc()).limit(_size)
+            with tell_db.get_engine().connect() as conn:
+                return conn.execute(_query.where(match(conn))).fetchall()
+        return f
+
+    _content = func.coalesce(tell_db.TellMessage.Content, TellRecord.Content)
+    print('%-40s %10s' % ('lookup', 'ms'))
+    for name, f in (('text, all nicks, LIKE scan', all_nicks(lambda conn: and_(*[_content.like('%' + w + '%')
+                                                                                  for w in _words]))),
+                    ('text, all nicks, FTS5', all_nicks(lambda conn: tell_db._text_match(conn, _words))),
+                    ('text, one nick, FTS5', lambda: TellDB.search_tells('nick0', _words, limit=_size))):
+        print('%-40s %10.2f' % (name, best(f)[0] * 1000))
+
+    # Page N of one nick's history, by OFFSET and by cursor
+    _nick = 'nick0'
+    _cursor = None
+    for _ in range(args.pages):
+        _page = TellDB.search_tells(_nick, before=_cursor, limit=_size)
+        if not _page:
+            break
+        _cursor = (_page[-1].Timestamp, _page[-1].ID)
+
+    def offset():
+        _query = select(TellRecord.ID).where((TellRecord.FromNickKey == _nick) | (TellRecord.ToNickKey == _nick)) \
+            .order_by(TellRecord.Timestamp.desc(), TellRecord.ID.desc()).offset(args.pages * _size).limit(_size)
+        with tell_db.get_engine().connect() as conn:
+            return conn.execute(_query).fetchall()
+
+    print('%-40s %10.2f' % ('page %d, OFFSET' % args.pages, best(offset)[0] * 1000))
+    print('%-40s %10.2f' % ('page %d, keyset cursor' % args.pages,
+                            best(lambda: TellDB.search_tells(_nick, before=_cursor, limit=_size))[0] * 1000))
+
+
+if __name__ == '__main__':
+    main()
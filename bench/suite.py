@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Benchmarks of the tell hot paths on a synthetic SQLite database, results as JSON.
+#
+#   python bench/suite.py [--tells 50000] [--nicks 5000] [--rate 50] [--output new.json] [--compare old.json]
+#
+# Seeds N unread tells across M nicks, then measures load_unread (time and memory), inFilter per
+# message for channel traffic without mail and for nicks with a backlog, multi-recipient tell
+# throughput and tellrefresh (incremental and --full). With --compare, prints each number next to
+# the one from an earlier run.
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _harness import ROOT, load_plugin, make_plugin  # noqa: E402
+
+
+class FakeIrc(object):
+    nick = 'tellbench'
+    prefix = 'tellbench!tell@bench.example.org'
+
+    def __init__(self):
+        self.sent = 0
+
+    def queueMsg(self, m):
+        self.sent += 1
+
+
+# Unread tells for nick0..nick<nicks-1>, inserted straight into the table
+def seed(tell_db, tells, nicks, seed):
+    _rand = random.Random(seed)
+    _now = datetime.datetime.now()
+    _rows = []
+    for i in range(tells):
+        _to = 'nick%d' % _rand.randrange(nicks)
+        _from = 'sender%d' % _rand.randrange(500)
+        _rows.append({'FromNick': _from, 'FromNickKey': _from, 'ToNick': _to,
+                      'ToNickKey': tell_db.TellDB.nick_key(_to), 'Content': 'x' * _rand.randint(10, 200),
+                      'Private': _rand.random() < 0.3, 'Read': False,
+                      'Timestamp': _now - datetime.timedelta(seconds=_rand.randrange(10 ** 7)), 'Modified': _now})
+    with tell_db.get_engine().begin() as conn:
+        for i in range(0, len(_rows), 10000):
+            conn.execute(tell_db.TellRecord.__table__.insert(), _rows[i:i + 10000])
+
+
+def latencies(f, items):
+    _times = []
+    _clock = time.perf_counter
+    for item in items:
+        _start = _clock()
+        f(item)
+        _times.append(_clock() - _start)
+    return _times
+
+
+def summary(times):
+    _sorted = sorted(times)
+    _n = len(_sorted)
+    return {'count': _n,
+            'mean_ns': sum(_sorted) / _n * 1e9,
+            'p50_ns': _sorted[_n // 2] * 1e9,
+            'p99_ns': _sorted[min(_n - 1, int(_n * 0.99))] * 1e9,
+            'max_ns': _sorted[-1] * 1e9}
+
+
+def bench_load_unread(lib, repeat):
+    _times = []
+    for _ in range(repeat):
+        _start = time.perf_counter()
+        lib.load_unread()
+        _times.append(time.perf_counter() - _start)
+
+    # Memory of a fresh cache, traced apart from the timing runs
+    lib.unread_tells = {}
+    gc.collect()
+    tracemalloc.start()
+    lib.load_unread()
+    gc.collect()
+    _retained, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'tells': lib.get_tell_count(), 'seconds': min(_times), 'peak_bytes': _peak,
+            'retained_bytes': _retained, 'bytes_per_tell': float(_retained) / max(1, lib.get_tell_count())}
+
+
+# Channel traffic from nicks without mail, K messages/sec for `duration` seconds worth
+def bench_infilter_nomail(cb, irc, ircmsgs, rate, duration, speakers):
+    _msgs = [ircmsgs.privmsg('#busy', 'just chatting about things in the channel, nothing special',
+                             prefix='speaker%d!user@host' % (i % speakers)) for i in range(rate * duration)]
+    for m in _msgs[:speakers]:
+        cb.inFilter(irc, m)
+    _result = summary(latencies(lambda m: cb.inFilter(irc, m), _msgs))
+    # Share of one CPU the filter needs to keep up with the traffic
+    _result['cpu_share_at_rate'] = _result['mean_ns'] / 1e9 * rate
+    return _result
+
+
+# Nicks with a backlog speaking once each, every message delivers their whole mailbox
+def bench_infilter_backlog(cb, irc, ircmsgs, nicks, sample):
+    _targets = ['nick%d' % n for n in range(min(nicks, sample)) if cb.queryTell.has_mail('nick%d' % n)]
+    _tells = sum(len(cb.queryTell.query_post(n).tells) for n in _targets)
+    _msgs = [ircmsgs.privmsg('#busy', 'back again', prefix='%s!user@host' % n) for n in _targets]
+    _sent = irc.sent
+    _result = summary(latencies(lambda m: cb.inFilter(irc, m), _msgs))
+    _result['tells'] = _tells
+    _result['lines'] = irc.sent - _sent
+    _result['mean_ns_per_tell'] = _result['mean_ns'] * _result['count'] / max(1, _tells)
+    return _result
+
+
+def bench_tell(lib, sends, recipients):
+    _now = datetime.datetime.now()
+    _nicks = [['friend%d' % (i * recipients + r) for r in range(recipients)] for i in range(sends)]
+    _start = time.perf_counter()
+    for to_nicks in _nicks:
+        lib.insert_tells('bench', to_nicks, 'see you at the meeting', False, _now)
+    _secs = time.perf_counter() - _start
+    return {'sends': sends, 'recipients': recipients, 'seconds': _secs,
+            'sends_per_sec': sends / _secs, 'tells_per_sec': sends * recipients / _secs}
+
+
+def bench_refresh(lib, tell_db, external):
+    _result = {}
+
+    _start = time.perf_counter()
+    lib.sync_unread()
+    _result['sync_unchanged_seconds'] = time.perf_counter() - _start
+
+    # Written by another tool, picked up by the incremental sync
+    _now = datetime.datetime.now()
+    with tell_db.get_engine().begin() as conn:
+        conn.execute(tell_db.TellRecord.__table__.insert(), [
+            {'FromNick': 'tool', 'ToNick': 'external%d' % i, 'ToNickKey': 'external%d' % i, 'Content': 'hello',
+             'Private': False, 'Read': False, 'Timestamp': _now, 'Modified': _now} for i in range(external)])
+    _start = time.perf_counter()
+    _result['sync_applied'] = lib.sync_unread()
+    _result['sync_seconds'] = time.perf_counter() - _start
+
+    _start = time.perf_counter()
+    lib.load_unread()
+    _result['full_seconds'] = time.perf_counter() - _start
+    return _result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Every numeric leaf as 'section.name' => value
+def flatten(results, prefix=''):
+    _flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            _flat.update(flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            _flat[prefix + k] = v
+    return _flat
+
+
+def compare(old, new):
+    _old = flatten(old['results'])
+    for name, value in sorted(flatten(new['results']).items()):
+        if name in _old and _old[name]:
+            print('%-45s %14.4g %14.4g %7.2fx' % (name, _old[name], value, value / _old[name]), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the tell hot paths, as JSON')
+    parser.add_argument('--tells', type=int, default=50000, help='unread tells seeded')
+    parser.add_argument('--nicks', type=int, default=5000, help='nicks the seeded tells are spread over')
+    parser.add_argument('--rate', type=int, default=50, help='channel messages per second')
+    parser.add_argument('--duration', type=int, default=600, help='seconds of channel traffic replayed')
+    parser.add_argument('--speakers', type=int, default=500, help='distinct nicks without mail talking')
+    parser.add_argument('--backlog-sample', type=int, default=2000, help='nicks with mail that speak')
+    parser.add_argument('--sends', type=int, default=1000, help='tell commands for the throughput run')
+    parser.add_argument('--recipients', type=int, default=5, help='nicks per tell command')
+    parser.add_argument('--external', type=int, default=1000, help='rows written outside the bot before a sync')
+    parser.add_argument('--repeat', type=int, default=3, help='load_unread runs, the best one counts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    parser.add_argument('--compare', help='JSON of an earlier run to compare against')
+    args = parser.parse_args()
+    # load_plugin moves to a scratch directory
+    for name in ('output', 'compare'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    mod, irc = load_plugin()
+    import supybot.ircmsgs as ircmsgs
+    from Tell.local import tell_db
+    import sqlalchemy
+
+    cb = make_plugin(mod, irc)
+    lib = cb.queryTell
+    fake = FakeIrc()
+
+    seed(tell_db, args.tells, args.nicks, args.seed)
+
+    _results = {}
+    _results['load_unread'] = bench_load_unread(lib, args.repeat)
+    _results['infilter_nomail'] = bench_infilter_nomail(cb, fake, ircmsgs, args.rate, args.duration, args.speakers)
+    _results['tellrefresh'] = bench_refresh(lib, tell_db, args.external)
+    _results['infilter_backlog'] = bench_infilter_backlog(cb, fake, ircmsgs, args.nicks, args.backlog_sample)
+    _results['tell'] = bench_tell(lib, args.sends, args.recipients)
+    cb.die()
+
+    _report = {
+        'meta': {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                 'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__,
+                 'platform': platform.platform()},
+        'params': vars(args),
+        'results': _results,
+    }
+    _json = json.dumps(_report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(_json + '\n')
+    else:
+        print(_json)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), _report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import collections
+import sys
+import threading
+import time
+
+
+# Size bounded dict that throws out the least recently used key when full, calling
+# on_evict(key, value) for it if given. Lookups through [] / get() count as a use, `in` does not.
+# Safe to share between threads.
+class LRUCache(collections.abc.MutableMapping):
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._d = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            _v = self._d[key]
+            self._d.move_to_end(key)
+            return _v
+
+    def __setitem__(self, key, value):
+        _evicted = []
+        with self._lock:
+            if key in self._d:
+                self._d.move_to_end(key)
+            self._d[key] = value
+            while len(self._d) > self.max_size:
+                _evicted.append(self._d.popitem(last=False))
+        if self.on_evict is not None:
+            for k, v in _evicted:
+                self.on_evict(k, v)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._d[key]
+
+    # In one go, another key's eviction may otherwise sneak in between the lookup and the delete
+    def pop(self, key, *default):
+        with self._lock:
+            return self._d.pop(key, *default)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def copy(self):
+        _c = LRUCache(self.max_size, self.on_evict)
+        with self._lock:
+            _c._d = self._d.copy()
+        return _c
+
+
+# Size bounded set of keys, oldest ones are forgotten first
+class LRUSet(object):
+
+    def __init__(self, max_size):
+        self._d = LRUCache(max_size)
+
+    def add(self, key):
+        self._d[key] = None
+
+    def discard(self, key):
+        self._d.pop(key, None)
+
+    def clear(self):
+        self._d.clear()
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __len__(self):
+        return len(self._d)
+
+
+# Epoch seconds for a naive local datetime, as stored in the Timestamp column. The fraction of
+# a second is kept, a tell sent just now must not read as a second old.
+def to_epoch(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+
+# One cached unread tell. Slotted and with an epoch float timestamp instead of a datetime, since
+# large backlogs keep hundreds of thousands of these around. Sender nicks are interned so rows
+# from the same sender share one string.
+class CachedTell(object):
+
+    __slots__ = ('id', 'content', 'time', 'private', 'sender')
+
+    def __init__(self, id, content, time, private, sender):
+        self.id = id
+        self.content = content
+        self.time = time
+        self.private = private
+        self.sender = sender
+
+    @classmethod
+    def create(cls, id, content, dt, private, sender):
+        return cls(id, content, to_epoch(dt), bool(private), sys.intern(sender))
+
+    @classmethod
+    def from_record(cls, record):
+        return cls.create(record.ID, record.Content, record.Timestamp, record.Private, record.FromNick)
+
+
+# Unread tells of one nick. paused is set when delivery stopped after a page, the rest waits for
+# moretells or new mail. Delays are kept apart in TellLib.delays, a nick may delay before having
+# any mail.
+class Mailbox(object):
+
+    __slots__ = ('tells', 'paused')
+
+    def __init__(self, tells=None):
+        self.tells = tells if tells is not None else []
+        self.paused = False
+
+    def has_tell(self, tell_id):
+        for t in self.tells:
+            if t.id == tell_id:
+                return True
+        return False
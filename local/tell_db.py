@@ -1,41 +1,623 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine, update
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import update
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+from sqlalchemy import func, select, inspect, text, or_, and_, literal
+from sqlalchemy.exc import OperationalError
+import collections
+import datetime
+import itertools
 import os
+import re
+import threading
+import uuid
+
+import supybot.ircutils as ircutils
+from supybot.utils.structures import CacheDict
+
+from .tell_engine import get_holder
+from .tell_stats import STATS
+from .tell_writer import WriteBehindQueue
 
 Base = declarative_base()
 
 
 class TellDB(object):
 
+    # Write-behind queue, None when writes commit synchronously
+    writer = None
+
+    # IRC casemapping used to build ToNickKey, see ircutils.toLower
+    casemapping = 'rfc1459'
+
+    # nick => nick_key(nick), so the hot path doesn't lower the same nicks over and over
+    _nick_keys = CacheDict(10000)
+
+    # Name of this bot in shared mode, where inserts and claims are recorded in tell_change for
+    # the other bots on the database. None when this bot is the only one.
+    instance = None
+
+    # Store the text of a tell sent to several nicks once, in tell_message. normalize_tells has
+    # looked at every row up to normalized_id.
+    normalize = False
+    normalized_id = 0
+
+    # Client side ID sequence used in write-behind mode
+    _id_seq = None
+    _id_lock = threading.Lock()
+    # Write-behind ops not in the table yet, so lookups can take them into account instead of
+    # waiting on the queue: ID => queued insert row, and the IDs queued to be flagged read
+    _queued_rows = {}
+    _queued_reads = set()
+    _queued_lock = threading.Lock()
+
     @staticmethod
     def commit_db():
         session.commit()
 
-    # FromNick=msg.nick, ToNick=i, Content=message, Private=self.pm, Read=0,Timestamp=_dt
+    # Database URL (None for TELL_CONNECTION_STRING) and pool settings of the engine. It is only
+    # rebuilt when they changed, so reloading the plugin keeps the connections it has.
     @staticmethod
-    def insert_tell(from_nick, to_nick, message, private, time):
-        new_tell = TellRecord(FromNick=from_nick, ToNick=to_nick, Content=message, Private=private, Read=0,
-                              Timestamp=time)
-        session.add(new_tell)
-        session.commit()
+    def configure_engine(url, pool_size, max_overflow, pool_recycle, pool_pre_ping):
+        if get_holder().configure(url, pool_size=pool_size, max_overflow=max_overflow,
+                                  pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping):
+            session.remove()
+
+    # Give back this thread's session, for threads that are done with the database
+    @staticmethod
+    def end_session():
+        session.remove()
+
+    # Give back this thread's session and close the pooled connections
+    @staticmethod
+    def dispose():
+        session.remove()
+        get_holder().dispose()
+
+    # Apply pending schema migrations
+    @staticmethod
+    def migrate():
+        return migrate()
+
+    @staticmethod
+    def configure_shared(instance):
+        TellDB.instance = instance
+
+    @staticmethod
+    def configure_normalize(normalize):
+        TellDB.normalize = normalize
+
+    @staticmethod
+    def set_casemapping(casemapping):
+        TellDB.casemapping = casemapping
+        TellDB._nick_keys = CacheDict(10000)
+
+    # Normalized nick, what ToNickKey holds and what the in-memory cache is keyed by
+    @staticmethod
+    def nick_key(nick):
+        try:
+            return TellDB._nick_keys[nick]
+        except KeyError:
+            _key = TellDB._nick_keys[nick] = ircutils.toLower(nick, TellDB.casemapping)
+            return _key
+
+    # Fill in ToNickKey and FromNickKey for rows written without them (by older versions or
+    # outside tools), in chunks so we never hold a long write lock. keys are the (nick, key)
+    # column names to fill. Returns the number of rows fixed.
+    @staticmethod
+    def fill_nick_keys(conn=None, chunk_size=1000, keys=(('ToNick', 'ToNickKey'), ('FromNick', 'FromNickKey'))):
+        _count = 0
+        for nick, key in keys:
+            while True:
+                if conn is not None:
+                    _fixed = TellDB._fill_nick_keys_chunk(conn, chunk_size, nick, key)
+                else:
+                    with get_engine().begin() as _conn:
+                        _fixed = TellDB._fill_nick_keys_chunk(_conn, chunk_size, nick, key)
+                _count += _fixed
+                if _fixed < chunk_size:
+                    break
+        return _count
 
-        # Return inserted id
-        return new_tell.ID
+    @staticmethod
+    def _fill_nick_keys_chunk(conn, chunk_size, nick, key):
+        _table = TellRecord.__table__
+        _rows = conn.execute(select(_table.c.ID, _table.c[nick]).where(_table.c[key].is_(None))
+                             .limit(chunk_size)).fetchall()
+
+        # One UPDATE per distinct key rather than per row
+        _by_key = {}
+        for _id, _nick in _rows:
+            _by_key.setdefault(TellDB.nick_key(_nick), []).append(_id)
+        for _key, _ids in _by_key.items():
+            conn.execute(_table.update().where(_table.c.ID.in_(_ids)).values({key: _key}))
+        return len(_rows)
 
+    # Queue writes and group commit them from a background thread. IDs get handed out from a
+    # client side sequence seeded from MAX(ID), so only one writer may use the table in this mode.
     @staticmethod
-    def query_unread():
-        _d = session.query(TellRecord).filter(TellRecord.Read == 0).all()
+    def start_write_behind(queue_size, batch_size, interval):
+        if TellDB.writer is not None:
+            return
+
+        _max = session.query(func.max(TellRecord.ID)).scalar()
         session.commit()
+        TellDB._id_seq = itertools.count((_max or 0) + 1)
+        TellDB.writer = WriteBehindQueue(TellDB._flush_writes, queue_size, batch_size, interval,
+                                         dropped=TellDB._forget_writes)
+
+    # Drain anything still queued and go back to synchronous writes
+    @staticmethod
+    def stop_write_behind():
+        if TellDB.writer is None:
+            return
+
+        TellDB.writer.stop()
+        TellDB.writer = None
+        TellDB._id_seq = None
+
+    # Block until queued writes have been flushed, so reads see them
+    @staticmethod
+    def flush():
+        if TellDB.writer is not None:
+            TellDB.writer.join()
+
+    @staticmethod
+    def _next_id():
+        with TellDB._id_lock:
+            return next(TellDB._id_seq)
+
+    # Runs on the write-behind thread, so it gets a session of its own
+    @staticmethod
+    def _flush_writes(ops):
+        _rows = [r for op, payload in ops if op == 'insert' for r in payload]
+        _ids = [i for op, payload in ops if op == 'read' for i in payload]
+
+        _session = DBSession()
+        try:
+            # Inserts first, a read flag in the same batch may point at one of them
+            if _rows:
+                _session.execute(TellRecord.__table__.insert(), _rows)
+            if _ids:
+                _session.execute(TellRecord.__table__.update().where(TellRecord.ID.in_(_ids))
+                                 .values(Read=True, Modified=datetime.datetime.now()))
+            _session.commit()
+        except:
+            _session.rollback()
+            raise
+        finally:
+            _session.close()
+        TellDB._forget_writes(ops)
+
+    @staticmethod
+    def _queue_write(op, payload):
+        with TellDB._queued_lock:
+            if op == 'insert':
+                TellDB._queued_rows.update((r['ID'], r) for r in payload)
+            else:
+                TellDB._queued_reads.update(payload)
+        TellDB.writer.put(op, payload)
+
+    # Ops that were written, or dropped after failing
+    @staticmethod
+    def _forget_writes(ops):
+        with TellDB._queued_lock:
+            for op, payload in ops:
+                if op == 'insert':
+                    for r in payload:
+                        TellDB._queued_rows.pop(r['ID'], None)
+                else:
+                    TellDB._queued_reads.difference_update(payload)
+
+    # Unread tells from queued inserts that match, and the IDs queued to be flagged read. Taken
+    # before the table is queried, anything flushed in between is in the table by then.
+    @staticmethod
+    def _queued_unread(match):
+        if TellDB.writer is None:
+            return [], set()
+        with TellDB._queued_lock:
+            _reads = set(TellDB._queued_reads)
+            _rows = [_QueuedTell(r['ID'], r['FromNick'], r['ToNick'], r['Content'], r['Private'], r['Timestamp'],
+                                 r['DeliverAt'])
+                     for r in TellDB._queued_rows.values() if r['ID'] not in _reads and match(r)]
+        return _rows, _reads
+
+    # Same tell for several nicks: one multi-row INSERT in one transaction. Returns the new IDs in
+    # the same order as to_nicks. deliver_at holds them back until then.
+    @staticmethod
+    def insert_tells(from_nick, to_nicks, message, private, time, deliver_at=None):
+        if not to_nicks:
+            return []
+
+        _modified = datetime.datetime.now()
+        _from_key = TellDB.nick_key(from_nick)
+        _rows = [{'FromNick': from_nick, 'FromNickKey': _from_key, 'ToNick': n, 'ToNickKey': TellDB.nick_key(n),
+                  'Content': message,
+                  'Private': private, 'Read': False, 'Timestamp': time, 'DeliverAt': deliver_at,
+                  'Modified': _modified} for n in to_nicks]
+
+        if TellDB.writer is not None:
+            for r in _rows:
+                r['ID'] = TellDB._next_id()
+            TellDB._queue_write('insert', _rows)
+            return [r['ID'] for r in _rows]
+
+        _table = TellRecord.__table__
+        try:
+            # One tell_message row for the text, the tell rows point at it
+            _message_id = None
+            if TellDB.normalize and len(to_nicks) > 1:
+                _message_id = session.execute(TellMessage.__table__.insert().values(Content=message))\
+                    .inserted_primary_key[0]
+                for r in _rows:
+                    r.update(Content='', MessageID=_message_id)
+
+            if get_engine().dialect.full_returning:
+                _result = session.execute(_table.insert().values(_rows).returning(_table.c.ID, _table.c.ToNick))
+                _fetched = _result.fetchall()
+            else:
+                # No RETURNING (MySQL, SQLite), read the IDs back inside the same transaction by
+                # a token only this batch has. Matching on the values would miss rows whose
+                # Timestamp the database rounded, and catch identical sends running alongside.
+                _token = uuid.uuid4().hex
+                for r in _rows:
+                    r['ClaimToken'] = _token
+                session.execute(_table.insert().values(_rows))
+                _fetched = session.execute(
+                    select(_table.c.ID, _table.c.ToNick)
+                    .where(_table.c.ToNickKey.in_(set(r['ToNickKey'] for r in _rows)))
+                    .where(_table.c.ClaimToken == _token)
+                    .order_by(_table.c.ID)).fetchall()
+            TellDB._log_changes(session, [r[0] for r in _fetched])
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+        # Hand the IDs back per nick, in insert order, so duplicate nicks each get their own
+        _by_nick = {}
+        for _id, _nick in _fetched:
+            _by_nick.setdefault(_nick, []).append(_id)
+        return [_by_nick[n].pop(0) for n in to_nicks]
+
+    # Unread tells, as rows of the columns the cache needs rather than ORM objects, fetched
+    # chunk_size rows at a time through a server-side cursor where the driver has one, so a large
+    # table is never held in memory twice
+    @staticmethod
+    def stream_unread(chunk_size=1000):
+        TellDB.flush()
+        with get_engine().connect() as conn:
+            _result = conn.execution_options(stream_results=True).execute(
+                _unread_select().order_by(TellRecord.ID))
+            for _rows in _result.partitions(chunk_size):
+                yield from _rows
+
+    # Unread tells of a single nick (any case) that are due, for lazily filled caches. Like the
+    # other lookups below, writes still in the write-behind queue are merged in.
+    @staticmethod
+    def query_unread_for(nick):
+        _key = TellDB.nick_key(nick)
+        _now = datetime.datetime.now()
+        _queued, _reads = TellDB._queued_unread(lambda r: r['ToNickKey'] == _key and _due(r, _now))
+        with get_engine().connect() as conn:
+            _rows = conn.execute(_unread_select()
+                                 .where(TellRecord.ToNickKey == _key)
+                                 .where(or_(TellRecord.DeliverAt.is_(None), TellRecord.DeliverAt <= _now))
+                                 .order_by(TellRecord.ID)).fetchall()
+        return _merge_queued(_rows, _queued, _reads)
+
+    # query_unread_for for several nicks, one query per chunk_size of them
+    @staticmethod
+    def query_unread_for_many(nicks, chunk_size=500):
+        _keys = sorted(set(TellDB.nick_key(n) for n in nicks))
+        _now = datetime.datetime.now()
+        _wanted = set(_keys)
+        _queued, _reads = TellDB._queued_unread(lambda r: r['ToNickKey'] in _wanted and _due(r, _now))
+        _rows = []
+        with get_engine().connect() as conn:
+            for i in range(0, len(_keys), chunk_size):
+                _rows += conn.execute(_unread_select()
+                                      .where(TellRecord.ToNickKey.in_(_keys[i:i + chunk_size]))
+                                      .where(or_(TellRecord.DeliverAt.is_(None), TellRecord.DeliverAt <= _now))
+                                      .order_by(TellRecord.ID)).fetchall()
+        return _merge_queued(_rows, _queued, _reads)
+
+    # Unread tells held back until a later time
+    @staticmethod
+    def query_scheduled():
+        _now = datetime.datetime.now()
+        _queued, _reads = TellDB._queued_unread(lambda r: not _due(r, _now))
+        with get_engine().connect() as conn:
+            _rows = conn.execute(_unread_select()
+                                 .where(TellRecord.DeliverAt > _now)
+                                 .order_by(TellRecord.ID)).fetchall()
+        return _merge_queued(_rows, _queued, _reads)
+
+    # Flag tells read only if nobody else did yet, for delivery when several bots share the
+    # table. Returns the IDs this call got, the caller may only relay those. Rows are stamped with
+    # a token, so the ones we got can be told apart when the rowcount says some went elsewhere.
+    @staticmethod
+    def claim_tells(record_ids):
+        if not record_ids:
+            return []
+
+        _table = TellRecord.__table__
+        _token = uuid.uuid4().hex
+        try:
+            _result = session.execute(
+                _table.update().where(_table.c.ID.in_(record_ids)).where(_table.c.Read == 0)
+                .values(Read=True, ClaimToken=_token, Modified=datetime.datetime.now()))
+            if _result.rowcount == len(set(record_ids)):
+                _claimed = list(record_ids)
+            else:
+                _claimed = [r[0] for r in session.execute(
+                    select(_table.c.ID).where(_table.c.ID.in_(record_ids)).where(_table.c.ClaimToken == _token))]
+            TellDB._log_changes(session, _claimed)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        return _claimed
+
+    # Hand claimed tells back, unread, when the bot that claimed them won't send them after all.
+    # The other bots see them again through the change log. Returns rows released.
+    @staticmethod
+    def release_claims(record_ids):
+        if not record_ids:
+            return 0
+
+        _table = TellRecord.__table__
+        try:
+            _result = session.execute(
+                _table.update().where(_table.c.ID.in_(record_ids)).where(_table.c.Read == 1)
+                .values(Read=False, ClaimToken=None, Modified=datetime.datetime.now()))
+            TellDB._log_changes(session, list(record_ids))
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        return _result.rowcount
+
+    # Record changed tells for the other bots, in the caller's transaction
+    @staticmethod
+    def _log_changes(conn, record_ids):
+        if TellDB.instance is None or not record_ids:
+            return
+        _now = datetime.datetime.now()
+        conn.execute(TellChange.__table__.insert(),
+                     [{'TellID': i, 'Instance': TellDB.instance, 'Created': _now} for i in record_ids])
+
+    # Last change log entry, where polling starts after a full load
+    @staticmethod
+    def change_log_mark():
+        with get_engine().connect() as conn:
+            return conn.execute(select(func.max(TellChange.__table__.c.ID))).scalar() or 0
+
+    # Tells other bots changed after change log entry `after`, as (new mark, rows in ID order).
+    # The last `overlap` entries are read again, IDs may become visible out of order on servers
+    # with concurrent transactions.
+    @staticmethod
+    def query_change_log(after, overlap=100):
+        _log = TellChange.__table__
+        _table = TellRecord.__table__
+        with get_engine().connect() as conn:
+            _entries = conn.execute(select(_log.c.ID, _log.c.TellID, _log.c.Instance)
+                                    .where(_log.c.ID > after - overlap)).fetchall()
+            _ids = set(e.TellID for e in _entries if e.Instance != TellDB.instance)
+            _rows = conn.execute(_tell_select().where(_table.c.ID.in_(_ids)).order_by(_table.c.ID)).fetchall() \
+                if _ids else []
+        return max([after] + [e.ID for e in _entries]), _rows
+
+    # Forget change log entries older than `before`, every bot has long seen them
+    @staticmethod
+    def prune_change_log(before):
+        _log = TellChange.__table__
+        with get_engine().begin() as conn:
+            return conn.execute(_log.delete().where(_log.c.Created < before)).rowcount
+
+    # Delete read tells last touched before `before`, optionally copying them to tell_archive
+    # first, with their text. Works in chunks of chunk_size rows, one short transaction each.
+    # tell_message rows nobody points at any more go too. Returns rows purged.
+    # The row with the highest ID always stays: SQLite (and MySQL before 8.0 on restart) hand out
+    # MAX(ID) + 1, so deleting it would give its ID out again, clashing with the archived copy and
+    # going behind the high-water marks of sync_marks.
+    @staticmethod
+    def purge_read(before, archive=False, chunk_size=1000):
+        TellDB.flush()
+        _table = TellRecord.__table__
+        _archive = TellArchive.__table__
+        _old = and_(_table.c.Read == 1,
+                    or_(_table.c.Modified < before, and_(_table.c.Modified.is_(None), _table.c.Timestamp < before)),
+                    _table.c.ID < select(func.max(_table.c.ID)).scalar_subquery())
+        _count = 0
+        while True:
+            with get_engine().begin() as conn:
+                _purged = conn.execute(select(_table.c.ID, _table.c.MessageID).where(_old).limit(chunk_size)).fetchall()
+                _ids = [r[0] for r in _purged]
+                if _ids:
+                    if archive:
+                        _columns = [c.name for c in _archive.columns if c.name != 'Archived']
+                        _archived = literal(datetime.datetime.now(), DateTime())
+                        _select = _tell_select()
+                        conn.execute(_archive.insert().from_select(
+                            _columns + ['Archived'],
+                            select(*[_select.selected_columns[c] for c in _columns] + [_archived])
+                            .select_from(_tell_join()).where(_table.c.ID.in_(_ids))))
+                    conn.execute(_table.delete().where(_table.c.ID.in_(_ids)))
+                    TellDB._delete_messages(conn, set(r[1] for r in _purged if r[1] is not None))
+            _count += len(_ids)
+            if len(_ids) < chunk_size:
+                return _count
+
+    @staticmethod
+    def _delete_messages(conn, message_ids):
+        if not message_ids:
+            return
+        _table = TellRecord.__table__
+        _message = TellMessage.__table__
+        conn.execute(_message.delete().where(_message.c.ID.in_(message_ids))
+                     .where(~select(_table.c.ID).where(_table.c.MessageID == _message.c.ID).exists()))
+
+    # Move the text of tells sent to several nicks at once into tell_message, one row per text, for
+    # tells inserted before normalize was set or by the write-behind queue. The rows of one tell
+    # command share FromNick, Timestamp and Content and are inserted together, so only rows past
+    # normalized_id are grouped. Works in chunks of chunk_size commands, one transaction each.
+    # Returns rows changed.
+    @staticmethod
+    def normalize_tells(chunk_size=1000):
+        TellDB.flush()
+        _table = TellRecord.__table__
+        _message = TellMessage.__table__
+        with get_engine().connect() as conn:
+            _top = conn.execute(select(func.max(_table.c.ID))).scalar() or 0
+        _range = and_(_table.c.ID > TellDB.normalized_id, _table.c.ID <= _top, _table.c.MessageID.is_(None))
+        _count = 0
+        while True:
+            with get_engine().begin() as conn:
+                _groups = conn.execute(select(_table.c.FromNick, _table.c.Timestamp, _table.c.Content)
+                                       .where(_range)
+                                       .group_by(_table.c.FromNick, _table.c.Timestamp, _table.c.Content)
+                                       .having(func.count() > 1).limit(chunk_size)).fetchall()
+                for _from, _timestamp, _content in _groups:
+                    _id = conn.execute(_message.insert().values(Content=_content)).inserted_primary_key[0]
+                    _count += conn.execute(_table.update()
+                                           .where(_range)
+                                           .where(_table.c.FromNick == _from)
+                                           .where(_table.c.Timestamp == _timestamp)
+                                           .where(_table.c.Content == _content)
+                                           .values(Content='', MessageID=_id)).rowcount
+            if len(_groups) < chunk_size:
+                TellDB.normalized_id = _top
+                return _count
+
+    # Give space back and refresh statistics after a purge: VACUUM on SQLite and PostgreSQL,
+    # OPTIMIZE TABLE on MySQL. Returns False for other databases.
+    @staticmethod
+    def compact():
+        _name = get_engine().dialect.name
+        _tables = [TellRecord.__table__.name, TellMessage.__table__.name, TellArchive.__table__.name]
+        with get_engine().connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            _prep = conn.dialect.identifier_preparer
+            if _name == 'sqlite':
+                conn.execute(text('VACUUM'))
+            elif _name == 'mysql':
+                conn.execute(text('OPTIMIZE TABLE %s' % ', '.join(_prep.quote(t) for t in _tables)))
+            elif _name == 'postgresql':
+                for t in _tables:
+                    conn.execute(text('VACUUM ANALYZE %s' % _prep.quote(t)))
+            else:
+                return False
+        return True
+
+    # Highest ID and Modified in the table, where an incremental sync picks up after a full load.
+    # One query each: alone, a MAX is read off the end of its index, together they scan it.
+    @staticmethod
+    def sync_marks():
+        TellDB.flush()
+        _table = TellRecord.__table__
+        with get_engine().connect() as conn:
+            return (conn.execute(select(func.max(_table.c.ID))).scalar(),
+                    conn.execute(select(func.max(_table.c.Modified))).scalar())
+
+    # Rows inserted after max_id or modified since `since`, read or not, in ID order. Two range
+    # scans on indexed columns rather than one OR that would scan the table.
+    @staticmethod
+    def query_changes(max_id, since):
+        TellDB.flush()
+        _table = TellRecord.__table__
+        with get_engine().connect() as conn:
+            _rows = {r.ID: r for r in conn.execute(_tell_select().where(_table.c.ID > (max_id or 0)))}
+            if since is not None:
+                for r in conn.execute(_tell_select().where(_table.c.Modified >= since)):
+                    _rows[r.ID] = r
+        return [_rows[i] for i in sorted(_rows)]
+
+    # Hold a nick's tells back until `until`, or lift the delay with None
+    @staticmethod
+    def set_delay(nick, until):
+        _table = TellDelay.__table__
+        _key = TellDB.nick_key(nick)
+        try:
+            session.execute(_table.delete().where(_table.c.NickKey == _key))
+            if until is not None:
+                session.execute(_table.insert().values(NickKey=_key, Until=until))
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+    # History of a nick, tells they sent or received (both by nick key), newest first. direction
+    # is 'sent', 'received' or None for both. words must all be in the text, looked up in the full
+    # text index where there is one. before=(Timestamp, ID) of the last row of the previous page
+    # continues after it, so deep pages cost the same as the first. private=False leaves private
+    # tells out. Sent and received are read apart, each in order from its own index, and merged.
+    @staticmethod
+    def search_tells(nick, words=None, since=None, until=None, direction=None, before=None, limit=10,
+                     private=True):
+        TellDB.flush()
+        _query = select(TellRecord.ID, TellRecord.FromNick, TellRecord.ToNick, _content(), TellRecord.Private,
+                        TellRecord.Read, TellRecord.Timestamp).select_from(_tell_join())
+        if not private:
+            _query = _query.where(TellRecord.Private.isnot(True))
+        if since is not None:
+            _query = _query.where(TellRecord.Timestamp >= since)
+        if until is not None:
+            _query = _query.where(TellRecord.Timestamp < until)
+        if before is not None:
+            _query = _query.where(or_(TellRecord.Timestamp < before[0],
+                                      and_(TellRecord.Timestamp == before[0], TellRecord.ID < before[1])))
+        _query = _query.order_by(TellRecord.Timestamp.desc(), TellRecord.ID.desc()).limit(limit)
+
+        _sides = []
+        if direction != 'received':
+            _sides.append(TellRecord.FromNickKey == TellDB.nick_key(nick))
+        if direction != 'sent':
+            _sides.append(TellRecord.ToNickKey == TellDB.nick_key(nick))
+
+        _rows = {}
+        with get_engine().connect() as conn:
+            if words:
+                _query = _query.where(_text_match(conn, words))
+            for side in _sides:
+                for r in conn.execute(_query.where(side)):
+                    _rows[r.ID] = r
+        return sorted(_rows.values(), key=lambda r: (r.Timestamp, r.ID), reverse=True)[:limit]
+
+    # Delays still running as [(nick key, until)], expired ones are cleaned up on the way
+    @staticmethod
+    def query_delays():
+        _table = TellDelay.__table__
+        _now = datetime.datetime.now()
+        try:
+            session.execute(_table.delete().where(_table.c.Until <= _now))
+            _d = session.execute(select(_table.c.NickKey, _table.c.Until)).fetchall()
+            session.commit()
+        except:
+            session.rollback()
+            raise
         return _d
 
+    # Flag a batch of tells as read with a single UPDATE ... WHERE ID IN (...) and one commit
     @staticmethod
-    def update_read(record_id):
-        stmt = TellRecord.__table__.update().where(TellRecord.ID == record_id).values(Read=True)
-        session.execute(stmt)
-        session.commit()
+    def update_read_many(record_ids):
+        if not record_ids:
+            return
+
+        if TellDB.writer is not None:
+            TellDB._queue_write('read', list(record_ids))
+            return
+
+        stmt = TellRecord.__table__.update().where(TellRecord.ID.in_(record_ids))\
+            .values(Read=True, Modified=datetime.datetime.now())
+        try:
+            session.execute(stmt)
+            TellDB._log_changes(session, record_ids)
+            session.commit()
+        except:
+            session.rollback()
+            raise
 
 
 class TellRecord(Base):
@@ -46,21 +628,318 @@ class TellRecord(Base):
     ID = Column(Integer, primary_key=True)
     FromNick = Column(String(255), nullable=False)
     ToNick = Column(String(255), nullable=False)
+    # ToNick lowered with the IRC casemapping (TellDB.nick_key). Added by schema migration 3.
+    ToNickKey = Column(String(255))
+    Content = Column(String(255), nullable=False)
+    Private = Column(Boolean())
+    Read = Column(Boolean())
+    Timestamp = Column(DateTime(), nullable=False)
+    # Not delivered before this time when set. Added by schema migration 4.
+    DeliverAt = Column(DateTime())
+    # Last insert or Read change, for incremental syncs. Tools writing to the table should set it
+    # when flagging tells read. Added by schema migration 5.
+    Modified = Column(DateTime())
+    # Token of the claim that flagged it read in shared mode. Added by schema migration 6. Until
+    # it is claimed, it holds the token of the insert_tells batch that wrote it, if any.
+    ClaimToken = Column(String(32))
+    # tell_message row holding the text, Content is empty then. Added by schema migration 8.
+    MessageID = Column(Integer)
+    # FromNick lowered like ToNickKey, for history searches. Added by schema migration 9.
+    FromNickKey = Column(String(255))
+
+    # Unread scans and per-nick lookups. Added to existing tables by schema migration 2.
+    __table_args__ = (
+        Index('ix_tell_read_tonick', 'Read', 'ToNick'),
+        Index('ix_tell_tonick_timestamp', 'ToNick', 'Timestamp'),
+        Index('ix_tell_tonickkey_read', 'ToNickKey', 'Read'),
+        Index('ix_tell_modified', 'Modified'),
+        Index('ix_tell_messageid', 'MessageID'),
+        # History searches, newest first, received and sent. Added by schema migration 9.
+        Index('ix_tell_tonickkey_timestamp', 'ToNickKey', 'Timestamp', 'ID'),
+        Index('ix_tell_fromnickkey_timestamp', 'FromNickKey', 'Timestamp', 'ID'),
+        # Timed tells still to come, for query_scheduled. Added by schema migration 10.
+        Index('ix_tell_read_deliverat', 'Read', 'DeliverAt'),
+    )
+
+
+class TellMessage(Base):
+
+    __tablename__ = 'tell_message'
+    # Text of a tell sent to several nicks, stored once when normalize is set. Added by schema
+    # migration 8.
+    ID = Column(Integer, primary_key=True)
+    Content = Column(String(255), nullable=False)
+
+
+class TellDelay(Base):
+
+    __tablename__ = 'tell_delay'
+    # delaytells, per nick key. Added by schema migration 4.
+    NickKey = Column(String(255), primary_key=True)
+    Until = Column(DateTime(), nullable=False)
+
+
+class TellArchive(Base):
+
+    __tablename__ = 'tell_archive'
+    # Read tells moved out of the tell table by purge_read. Added by schema migration 7.
+    ID = Column(Integer, primary_key=True, autoincrement=False)
+    FromNick = Column(String(255), nullable=False)
+    ToNick = Column(String(255), nullable=False)
+    ToNickKey = Column(String(255))
     Content = Column(String(255), nullable=False)
     Private = Column(Boolean())
     Read = Column(Boolean())
     Timestamp = Column(DateTime(), nullable=False)
+    DeliverAt = Column(DateTime())
+    Modified = Column(DateTime())
+    ClaimToken = Column(String(32))
+    Archived = Column(DateTime(), nullable=False)
+
+
+class TellChange(Base):
+
+    __tablename__ = 'tell_change'
+    # Tells inserted or claimed by one of the bots sharing the table, polled by the others.
+    # Added by schema migration 6.
+    ID = Column(Integer, primary_key=True)
+    TellID = Column(Integer, nullable=False)
+    Instance = Column(String(32), nullable=False)
+    Created = Column(DateTime(), nullable=False, index=True)
+
+
+class SchemaVersion(Base):
+
+    __tablename__ = 'tell_schema'
+    # One row per applied migration
+    Version = Column(Integer, primary_key=True)
+    Applied = Column(DateTime(), nullable=False)
+
+
+# Schema migrations, (version, function(connection)). Append new ones at the end and never change
+# an applied one. Each runs in its own transaction and must cope with the change already being
+# there, since dev databases get the current schema from create_all.
+def _migration_1(conn):
+    TellRecord.__table__.create(conn, checkfirst=True)
+
+
+def _migration_2(conn):
+    for name in ('ix_tell_read_tonick', 'ix_tell_tonick_timestamp'):
+        _index(name).create(conn, checkfirst=True)
+
+
+def _migration_3(conn):
+    _add_column(conn, TellRecord.__table__.c.ToNickKey)
+    TellDB.fill_nick_keys(conn, keys=[('ToNick', 'ToNickKey')])
+    _index('ix_tell_tonickkey_read').create(conn, checkfirst=True)
+
+
+def _migration_4(conn):
+    _add_column(conn, TellRecord.__table__.c.DeliverAt)
+    TellDelay.__table__.create(conn, checkfirst=True)
+
+
+def _migration_5(conn):
+    _add_column(conn, TellRecord.__table__.c.Modified)
+    _index('ix_tell_modified').create(conn, checkfirst=True)
+
+
+def _migration_6(conn):
+    _add_column(conn, TellRecord.__table__.c.ClaimToken)
+    TellChange.__table__.create(conn, checkfirst=True)
+
+
+def _migration_7(conn):
+    TellArchive.__table__.create(conn, checkfirst=True)
+
+
+def _migration_8(conn):
+    TellMessage.__table__.create(conn, checkfirst=True)
+    _add_column(conn, TellRecord.__table__.c.MessageID)
+    _index('ix_tell_messageid').create(conn, checkfirst=True)
+
+
+# History searches. Senders are matched by key like recipients. The full text index is a
+# contentless FTS5 table kept up to date by triggers on SQLite, FULLTEXT indexes on MySQL. Other
+# databases, and SQLite builds without FTS5, search with LIKE.
+def _migration_9(conn):
+    _add_column(conn, TellRecord.__table__.c.FromNickKey)
+    TellDB.fill_nick_keys(conn, keys=[('FromNick', 'FromNickKey')])
+    for name in ('ix_tell_tonickkey_timestamp', 'ix_tell_fromnickkey_timestamp'):
+        _index(name).create(conn, checkfirst=True)
+
+    if conn.dialect.name == 'sqlite':
+        try:
+            conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS tell_fts USING fts5(Content, content='')"))
+        except OperationalError:
+            return
+        for statement in _SQLITE_FTS:
+            conn.execute(text(statement))
+    elif conn.dialect.name == 'mysql':
+        for table in (TellRecord.__table__, TellMessage.__table__):
+            _name = 'ft_%s_content' % table.name
+            if _name not in [i['name'] for i in inspect(conn).get_indexes(table.name)]:
+                conn.execute(text('ALTER TABLE %s ADD FULLTEXT INDEX %s (Content)' % (
+                    conn.dialect.identifier_preparer.format_table(table), _name)))
+
+
+def _migration_10(conn):
+    _index('ix_tell_read_deliverat').create(conn, checkfirst=True)
+
+
+# Text of a tell row in trigger bodies, wherever it is kept. A contentless table only forgets a
+# row when given the text it indexed, so tell_message rows go after the tells using them.
+_SQLITE_TEXT = 'coalesce((SELECT Content FROM tell_message WHERE ID = {0}.MessageID), {0}.Content)'
+_SQLITE_FTS_DELETE = "INSERT INTO tell_fts (tell_fts, rowid, Content) VALUES ('delete', old.ID, %s); " % \
+    _SQLITE_TEXT.format('old')
+_SQLITE_FTS_INSERT = 'INSERT INTO tell_fts (rowid, Content) VALUES (new.ID, %s); ' % _SQLITE_TEXT.format('new')
+
+_SQLITE_FTS = [
+    'CREATE TRIGGER IF NOT EXISTS tell_fts_insert AFTER INSERT ON tell BEGIN %sEND' % _SQLITE_FTS_INSERT,
+    'CREATE TRIGGER IF NOT EXISTS tell_fts_delete AFTER DELETE ON tell BEGIN %sEND' % _SQLITE_FTS_DELETE,
+    # normalize_tells moves the text to tell_message, the indexed text stays the same
+    'CREATE TRIGGER IF NOT EXISTS tell_fts_update AFTER UPDATE OF Content, MessageID ON tell BEGIN %s%sEND' % (
+        _SQLITE_FTS_DELETE, _SQLITE_FTS_INSERT),
+    # Rows from before the index
+    'INSERT INTO tell_fts (rowid, Content) '
+    'SELECT tell.ID, coalesce(tell_message.Content, tell.Content) FROM tell '
+    'LEFT OUTER JOIN tell_message ON tell_message.ID = tell.MessageID '
+    'WHERE tell.ID NOT IN (SELECT rowid FROM tell_fts)',
+]
+
+
+# search_tells condition for rows whose text has every one of words
+def _text_match(conn, words):
+    _name = conn.dialect.name
+    if _name == 'sqlite' and inspect(conn).has_table('tell_fts'):
+        # Each word a quoted FTS5 string, so operators and punctuation in them don't count
+        _query = ' '.join('"%s"' % w.replace('"', '""') for w in words)
+        return TellRecord.ID.in_(text('SELECT rowid FROM tell_fts WHERE tell_fts MATCH :words')
+                                 .bindparams(words=_query).columns(ID=Integer))
+    if _name == 'mysql':
+        # Boolean mode, every word required. Operators are stripped from the words.
+        _query = ' '.join('+%s' % w for w in (re.sub(r'[^\w]+', '', w) for w in words) if w)
+        if _query:
+            return or_(TellRecord.Content.match(_query), TellMessage.Content.match(_query))
+    return and_(*[func.coalesce(TellMessage.Content, TellRecord.Content).ilike(
+        '%' + w.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%', escape='\\')
+        for w in words])
+
+
+def _index(name):
+    return [i for i in TellRecord.__table__.indexes if i.name == name][0]
+
+
+# ALTER TABLE ... ADD COLUMN, unless the column is already there
+def _add_column(conn, column):
+    if column.name in [c['name'] for c in inspect(conn).get_columns(column.table.name)]:
+        return
+    _prep = conn.dialect.identifier_preparer
+    conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+        _prep.format_table(column.table), _prep.format_column(column), column.type.compile(conn.dialect))))
+
+
+# tell with the tell_message rows some of them point at
+def _tell_join():
+    return TellRecord.__table__.outerjoin(TellMessage.__table__, TellRecord.MessageID == TellMessage.ID)
+
+
+# Content of a tell, wherever it is kept
+def _content():
+    return func.coalesce(TellMessage.Content, TellRecord.Content).label('Content')
+
+
+# Every column of tell, Content filled in from tell_message
+def _tell_select():
+    return select(*[_content() if c.name == 'Content' else c for c in TellRecord.__table__.columns])\
+        .select_from(_tell_join())
+
+
+# Unread tells with the columns the cache is built from
+def _unread_select():
+    return select(TellRecord.ID, TellRecord.FromNick, TellRecord.ToNick, _content(), TellRecord.Private,
+                  TellRecord.Timestamp, TellRecord.DeliverAt).select_from(_tell_join()).where(TellRecord.Read == 0)
+
+
+# A queued write-behind insert, with the columns of _unread_select
+_QueuedTell = collections.namedtuple('QueuedTell', 'ID FromNick ToNick Content Private Timestamp DeliverAt')
+
+
+def _due(row, now):
+    return row['DeliverAt'] is None or row['DeliverAt'] <= now
+
+
+# Rows from the table with the queued writes applied: inserts not flushed yet added, tells queued
+# to be flagged read left out
+def _merge_queued(rows, queued, reads):
+    if not queued and not reads:
+        return rows
+    _ids = set(r.ID for r in rows)
+    _rows = [r for r in rows if r.ID not in reads] + [r for r in queued if r.ID not in _ids]
+    _rows.sort(key=lambda r: r.ID)
+    return _rows
+
+
+# Time every public TellDB call into the db.<name> histograms. nick_key runs for every message and
+# never touches the database, and end_session doesn't query, so they're left alone. stream_unread
+# does its work while the caller iterates, its time shows up in theirs.
+for _name, _f in list(vars(TellDB).items()):
+    if isinstance(_f, staticmethod) and not _name.startswith('_') and \
+            _name not in ('nick_key', 'end_session', 'stream_unread'):
+        setattr(TellDB, _name, staticmethod(STATS.timed('db.' + _name, _f.__func__)))
+
+
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+    (8, _migration_8),
+    (9, _migration_9),
+    (10, _migration_10),
+]
+
+
+# Bring the schema up to date, returns the list of versions applied
+def migrate():
+    SchemaVersion.__table__.create(get_engine(), checkfirst=True)
+
+    with get_engine().connect() as conn:
+        _current = conn.execute(select(func.max(SchemaVersion.Version))).scalar() or 0
+
+    _applied = []
+    for version, migration in MIGRATIONS:
+        if version <= _current:
+            continue
+        with get_engine().begin() as conn:
+            migration(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(Version=version,
+                                                                 Applied=datetime.datetime.now()))
+        _applied.append(version)
+    return _applied
+
+
+# The engine, created on first use
+def get_engine():
+    _engine = get_holder().engine
+    if _engine is None:
+        _engine = get_holder().get()
+        # See if we need to create a new schema.
+        if 'IRC_BOT_DEV' in os.environ and os.environ['IRC_BOT_DEV'] == "1":
+            Base.metadata.create_all(_engine)
+    return _engine
 
 
-# Create engine for Database, Mysql, sqlite, etc
-engine = create_engine(os.environ['TELL_CONNECTION_STRING'])
-# See if we need to create a new schema.
-if 'IRC_BOT_DEV' in os.environ and os.environ['IRC_BOT_DEV'] == "1":
-    Base.metadata.create_all(engine)
+# Sessions ask for the engine when they first need a connection, not when they are made
+class TellSession(Session):
 
-Base.metadata.bind = engine
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return get_engine()
 
-# Create session
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
 
+# Create session. Thread local, so threaded commands and inFilter each get their own.
+DBSession = sessionmaker(class_=TellSession)
+session = scoped_session(DBSession)
@@ -0,0 +1,137 @@
+import datetime
+import heapq
+import itertools
+import re
+import threading
+import time
+
+import supybot.log as log
+import supybot.schedule as schedule
+from supybot.utils.structures import CacheDict
+
+
+# Token bucket: `burst` lines may go out back to back, after that one every 1/rate seconds.
+# Tokens may go negative, which books a slot in the future.
+class TokenBucket(object):
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    # Book the next slot, returns seconds from now until it may be used
+    def reserve(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+# One token bucket per target (channel or nick). A rate of 0 turns pacing off.
+class Pacer(object):
+
+    def __init__(self, rate=0, burst=5):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = CacheDict(10000)
+        self._lock = threading.Lock()
+
+    def configure(self, rate, burst):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self._buckets = CacheDict(10000)
+
+    def reserve(self, target, now=None):
+        if self.rate <= 0:
+            return 0
+        if now is None:
+            now = time.time()
+        with self._lock:
+            _bucket = self._buckets.get(target)
+            if _bucket is None:
+                _bucket = self._buckets[target] = TokenBucket(self.rate, self.burst, now)
+            return _bucket.reserve(now)
+
+
+# Min-heap of timed calls driven by a single supybot.schedule event, armed for the earliest
+# entry. Adding and expiring are O(log n), nothing has to rescan the mailboxes.
+class Timeline(object):
+
+    def __init__(self, name):
+        self.name = name
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        # Time the schedule event is armed for, None when it isn't
+        self._armed = None
+
+    # Call f(*args) once `when` (epoch seconds) has passed
+    def add(self, when, f, *args):
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._seq), f, args))
+            if self._armed is None or when < self._armed:
+                self._arm(when)
+
+    # Run everything that is due, then arm the event for the next entry
+    def run(self, now=None):
+        if now is None:
+            now = time.time()
+        _due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _due.append(heapq.heappop(self._heap))
+            self._disarm()
+            if self._heap:
+                self._arm(self._heap[0][0])
+
+        for _, _, f, args in _due:
+            try:
+                f(*args)
+            except Exception:
+                log.exception('Tell: timed call failed')
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+            self._disarm()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _arm(self, when):
+        self._disarm()
+        schedule.addEvent(self.run, when, self.name)
+        self._armed = when
+
+    def _disarm(self):
+        try:
+            schedule.removeEvent(self.name)
+        except KeyError:
+            pass
+        self._armed = None
+
+
+_DURATION = re.compile(r'(\d+[smhdw])+')
+_DURATION_PART = re.compile(r'(\d+)([smhdw])')
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+# When a timed tell is due: a relative duration like 90m or 1h30m, or a local date/time in ISO
+# format (2017-05-01T18:00). With past=True durations count back from now instead. Returns a
+# naive local datetime, raises ValueError.
+def parse_when(text, now=None, past=False):
+    if now is None:
+        now = datetime.datetime.now()
+    if _DURATION.fullmatch(text):
+        _delta = datetime.timedelta(seconds=sum(int(n) * _UNITS[u] for n, u in _DURATION_PART.findall(text)))
+        return now - _delta if past else now + _delta
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError('expected a duration like 1h30m or a date like 2017-05-01T18:00')
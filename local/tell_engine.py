@@ -0,0 +1,69 @@
+import os
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+
+# Create engine for Database, Mysql, sqlite, etc. SQLite file databases don't use a QueuePool,
+# so size and overflow only apply to real servers.
+def create_tell_engine(url, pool_size=5, max_overflow=10, pool_recycle=-1, pool_pre_ping=False):
+    _kwargs = {'pool_recycle': pool_recycle, 'pool_pre_ping': pool_pre_ping}
+    if make_url(url).get_backend_name() != 'sqlite':
+        _kwargs.update(pool_size=pool_size, max_overflow=max_overflow)
+    return create_engine(url, **_kwargs)
+
+
+# The tell database engine, created on first use from the configured URL, or
+# TELL_CONNECTION_STRING when none is set. Importing the plugin never connects.
+class EngineHolder(object):
+
+    def __init__(self):
+        self.engine = None
+        self.url = None
+        self.options = {}
+        self._lock = threading.RLock()
+
+    # Settings for the engine. The current one is kept when nothing changed, otherwise it is
+    # disposed and the next get() builds a new one. Returns whether anything changed.
+    def configure(self, url=None, **options):
+        with self._lock:
+            if url == self.url and options == self.options:
+                return False
+            self.url = url
+            self.options = options
+            if self.engine is not None:
+                self.engine.dispose()
+                self.engine = None
+            return True
+
+    def get(self):
+        _engine = self.engine
+        if _engine is not None:
+            return _engine
+
+        with self._lock:
+            if self.engine is None:
+                _url = self.url or os.environ.get('TELL_CONNECTION_STRING')
+                if not _url:
+                    raise RuntimeError('No tell database configured, set plugins.Tell.database '
+                                       'or TELL_CONNECTION_STRING')
+                self.engine = create_tell_engine(_url, **self.options)
+            return self.engine
+
+    # Close the pooled connections. The engine itself stays, and reconnects when used again.
+    def dispose(self):
+        with self._lock:
+            if self.engine is not None:
+                self.engine.dispose()
+
+
+# One holder per process. It lives on supybot.world, which plugin reloads leave alone, so a
+# reloaded plugin picks up the same engine instead of building another one. world is imported
+# here rather than at the top, importing it costs more than the rest of tell_db.
+def get_holder():
+    import supybot.world as world
+    _holder = getattr(world, 'tell_engine', None)
+    if _holder is None:
+        _holder = world.tell_engine = EngineHolder()
+    return _holder
@@ -0,0 +1,182 @@
+import string
+
+
+# A str.format template, checked and compiled once. Named fields are turned into positional ones,
+# so rendering doesn't build a kwargs dict and only the fields the template uses get computed.
+class Template(object):
+
+    __slots__ = ('template', 'fields', '_format')
+
+    def __init__(self, template, fields, format):
+        self.template = template
+        # Field names the template uses, in positional argument order
+        self.fields = fields
+        self._format = format
+
+    # Render from keyword values; values for fields the template doesn't use are ignored
+    def __call__(self, **values):
+        return self._format(*[values[f] for f in self.fields])
+
+    # Render callable taking *args, with each used field computed by extractors[field](*args)
+    def bind(self, extractors):
+        _format = self._format
+        _get = [extractors[f] for f in self.fields]
+        return lambda *args: _format(*[g(*args) for g in _get])
+
+
+# Parse and check `template`, which may only use the names in `allowed`. With `samples`
+# (field => example value) it is also rendered once, so bad format specs fail here rather than
+# halfway through a delivery. Raises ValueError with a readable reason.
+def compile_template(template, allowed, samples=None):
+    _fields = []
+    _parts = []
+    try:
+        _parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        raise ValueError(str(e))
+
+    for literal, name, spec, conversion in _parsed:
+        _parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if name is None:
+            continue
+        if name not in allowed:
+            if name == '' or name.isdigit():
+                raise ValueError('positional fields are not supported, use one of: %s' % ', '.join(allowed))
+            raise ValueError('unknown field {%s}, use one of: %s' % (name, ', '.join(allowed)))
+        if spec and '{' in spec:
+            raise ValueError('nested fields in format specs are not supported')
+        if name not in _fields:
+            _fields.append(name)
+        _parts.append('{%d%s%s}' % (_fields.index(name), '!' + conversion if conversion else '',
+                                    ':' + spec if spec else ''))
+
+    _compiled = Template(template, tuple(_fields), ''.join(_parts).format)
+    if samples is not None:
+        try:
+            _compiled(**samples)
+        except (ValueError, TypeError, IndexError) as e:
+            raise ValueError(str(e))
+    return _compiled
+
+
+# Seconds in the units naturaltime rounds to
+_MINUTE = 60
+_HOUR = 3600
+_DAY = 86400
+_YEAR_DAYS = 365
+_MONTH_DAYS = 30.5
+
+
+def _plural(n, unit):
+    return '%d %s%s' % (n, unit, '' if n == 1 else 's')
+
+
+# Same wording and rounding as humanize.naturaldelta(months=True) for whole seconds
+def naturaldelta(seconds):
+    days, seconds = divmod(seconds, _DAY)
+    years, days = divmod(days, _YEAR_DAYS)
+    months = round(days / _MONTH_DAYS)
+
+    if years == 0 and days == 0:
+        if seconds == 0:
+            return 'a moment'
+        if seconds == 1:
+            return 'a second'
+        if seconds < _MINUTE:
+            return _plural(seconds, 'second')
+        if seconds < _HOUR:
+            minutes = round(seconds / _MINUTE)
+            if minutes == 1:
+                return 'a minute'
+            if minutes == 60:
+                return 'an hour'
+            return _plural(minutes, 'minute')
+        hours = round(seconds / _HOUR)
+        if hours == 1:
+            return 'an hour'
+        if hours == 24:
+            return 'a day'
+        return _plural(hours, 'hour')
+
+    if years == 0:
+        if days == 1:
+            return 'a day'
+        if months == 0:
+            return _plural(days, 'day')
+        if months == 1:
+            return 'a month'
+        if months == 12:
+            return 'a year'
+        return _plural(months, 'month')
+
+    if years == 1:
+        if months == 0 and days == 0:
+            return 'a year'
+        if months == 0:
+            return '1 year, %s' % _plural(days, 'day')
+        if months == 1:
+            return '1 year, 1 month'
+        if months == 12:
+            return '2 years'
+        return '1 year, %s' % _plural(months, 'month')
+
+    return '{:,} years'.format(years)
+
+
+# Relative time for a number of seconds elapsed, like humanize.naturaltime: 'now',
+# '5 minutes ago', or '... from now' when negative (clock skew). Callers read the clock once and
+# pass the difference, so a whole backlog costs one time.time().
+def naturaltime(seconds):
+    _future = seconds < 0
+    _delta = naturaldelta(int(abs(seconds)))
+    if _delta == 'a moment':
+        return 'now'
+    return _delta + (' from now' if _future else ' ago')
+
+
+# Split text into pieces of at most `budget` UTF-8 bytes, at a space where there's one in the
+# second half of the piece, never in the middle of a character
+def split_text(text, budget):
+    _pieces = []
+    _rest = text
+    while len(_rest.encode('utf-8')) > budget:
+        _chunk = _rest.encode('utf-8')[:budget].decode('utf-8', 'ignore')
+        _cut = _chunk.rfind(' ')
+        if _cut > len(_chunk) // 2:
+            _chunk = _chunk[:_cut]
+        _pieces.append(_chunk)
+        _rest = _rest[len(_chunk):].lstrip(' ')
+    if _rest:
+        _pieces.append(_rest)
+    return _pieces
+
+
+# Greedily join items into as few lines as possible, each at most `budget` UTF-8 bytes. Items
+# that don't fit on a line of their own are split with split_text first.
+def pack_lines(items, budget, separator=' | '):
+    return [line for line, _ in pack_items(items, budget, separator)]
+
+
+# pack_lines, also telling which items end on each line: [(line, [item index, ...]), ...]
+def pack_items(items, budget, separator=' | '):
+    _sep_len = len(separator.encode('utf-8'))
+    _lines = []
+    _current = []
+    _current_len = 0
+    _ends = []
+    for index, item in enumerate(items):
+        for piece in split_text(item, budget):
+            _len = len(piece.encode('utf-8'))
+            if _current and _current_len + _sep_len + _len <= budget:
+                _current.append(piece)
+                _current_len += _sep_len + _len
+            else:
+                if _current:
+                    _lines.append((separator.join(_current), _ends))
+                _current = [piece]
+                _current_len = _len
+                _ends = []
+        _ends.append(index)
+    if _current:
+        _lines.append((separator.join(_current), _ends))
+    return _lines
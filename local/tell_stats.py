@@ -0,0 +1,123 @@
+import bisect
+import functools
+import os
+import threading
+import time
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Fixed bucket latency histogram. Observing is a bisect and a few additions, without a lock since
+# it sits on the per-message path: an update racing another thread's can very rarely get lost,
+# which is fine for statistics.
+class Histogram(object):
+
+    __slots__ = ('counts', 'sum', 'max')
+
+    def __init__(self):
+        # One count per bucket plus one for everything slower than the last
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, _bisect=bisect.bisect_left, _buckets=BUCKETS):
+        self.counts[_bisect(_buckets, seconds)] += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    # Upper bound of the bucket the q-th quantile falls in (the max for the overflow bucket)
+    def quantile(self, q):
+        _counts = list(self.counts)
+        _target = q * sum(_counts)
+        _seen = 0
+        for i, c in enumerate(_counts):
+            _seen += c
+            if c and _seen >= _target:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+
+# Counters, latency histograms and gauges of one process. Gauges are callables read when the
+# numbers are reported, for things that are cheaper to look up than to keep track of.
+class Stats(object):
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def histogram(self, name):
+        _h = self.histograms.get(name)
+        if _h is None:
+            with self._lock:
+                _h = self.histograms.setdefault(name, Histogram())
+        return _h
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    # f, with every call's time observed in the `name` histogram
+    def timed(self, name, f):
+        _h = self.histogram(name)
+        _clock = time.perf_counter
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            _start = _clock()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _h.observe(_clock() - _start)
+        return wrapper
+
+    def gauge(self, name, f):
+        self.gauges[name] = f
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    # Everything in the Prometheus text exposition format, names prefixed with tell_
+    def prometheus(self):
+        _lines = []
+        for name, f in sorted(self.gauges.items()):
+            _lines += ['# TYPE tell_%s gauge' % name, 'tell_%s %s' % (name, f())]
+        for name, value in sorted(self.counters.items()):
+            _lines += ['# TYPE tell_%s_total counter' % name, 'tell_%s_total %d' % (name, value)]
+
+        _lines.append('# TYPE tell_latency_seconds histogram')
+        for name, h in sorted(self.histograms.items()):
+            _counts = list(h.counts)
+            _seen = 0
+            for bound, c in zip(BUCKETS, _counts):
+                _seen += c
+                _lines.append('tell_latency_seconds_bucket{op="%s",le="%g"} %d' % (name, bound, _seen))
+            _lines.append('tell_latency_seconds_bucket{op="%s",le="+Inf"} %d' % (name, sum(_counts)))
+            _lines.append('tell_latency_seconds_sum{op="%s"} %r' % (name, h.sum))
+            _lines.append('tell_latency_seconds_count{op="%s"} %d' % (name, sum(_counts)))
+        return '\n'.join(_lines) + '\n'
+
+    # Write prometheus() to path for node_exporter's textfile collector. Written aside and
+    # renamed, so the collector never reads half a file.
+    def write_prometheus(self, path):
+        _tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(_tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(_tmp, path)
+
+
+# The process wide instance everything reports to
+STATS = Stats()
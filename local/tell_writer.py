@@ -0,0 +1,126 @@
+import queue
+import threading
+import time
+
+import supybot.log as log
+
+
+# Write-behind queue. Producers put ('insert', row) / ('read', ids) ops on a bounded queue and a
+# single background worker hands them to `flush` in group commits, either when `batch_size`
+# ops have piled up or when `interval` seconds have passed since the first op of the batch.
+# When a group commit fails its ops are flushed one at a time, so one bad op can't hold back the
+# others. An op failing `max_attempts` times is logged, dropped and handed to `dropped`.
+class WriteBehindQueue(object):
+
+    _STOP = object()
+
+    def __init__(self, flush, queue_size=1000, batch_size=100, interval=0.5, max_attempts=3, dropped=None):
+        self._flush = flush
+        self._dropped = dropped
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch_size = batch_size
+        self._interval = interval
+        self._max_attempts = max_attempts
+        # (op, failed attempts) that failed to flush, retried before anything else on the next
+        # cycle. Holds at most queue_size of them, the oldest go first.
+        self._pending = []
+        self._max_pending = queue_size
+        self._idle = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='Tell write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Blocks when the queue is full, so a stalled DB pushes back on producers instead of growing forever
+    def put(self, op, payload):
+        self._queue.put((op, payload))
+
+    # Wait until everything queued so far has been flushed, or dropped after failing
+    def join(self):
+        self._queue.join()
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+    # Drain the queue and stop the worker. Used on plugin die()/reload.
+    def stop(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            _batch = []
+            _stop = False
+
+            # With failed ops pending, wake up on the interval to retry them even if nothing new arrives
+            try:
+                _item = self._queue.get(timeout=self._interval if self._pending else None)
+            except queue.Empty:
+                self._commit([])
+                continue
+
+            _deadline = time.time() + self._interval
+            while True:
+                if _item is self._STOP:
+                    _stop = True
+                    break
+                _batch.append(_item)
+                if len(_batch) >= self._batch_size:
+                    break
+                _timeout = _deadline - time.time()
+                if _timeout <= 0:
+                    break
+                try:
+                    _item = self._queue.get(timeout=_timeout)
+                except queue.Empty:
+                    break
+
+            self._commit(_batch, retry=not _stop)
+
+            # task_done for the stop sentinel too
+            for _ in range(len(_batch) + (1 if _stop else 0)):
+                self._queue.task_done()
+
+            if _stop:
+                return
+
+    def _commit(self, batch, retry=True):
+        _ops = self._pending + [(item, 0) for item in batch]
+        if not _ops:
+            return
+        try:
+            self._flush([item for item, _ in _ops])
+            _ops = []
+        except Exception:
+            log.exception('Tell: write-behind flush of %s ops failed, retrying them one by one', len(_ops))
+            _ops = self._flush_each(_ops, retry)
+        with self._idle:
+            self._pending = _ops
+            if not _ops:
+                self._idle.notify_all()
+
+    # Flush ops on their own and return the ones that failed again, with their attempt counted.
+    # Ones out of attempts are dropped, on shutdown (retry False) every failing one is.
+    def _flush_each(self, ops, retry):
+        _failed = []
+        for item, attempts in ops:
+            try:
+                self._flush([item])
+            except Exception:
+                attempts += 1
+                if retry and attempts < self._max_attempts:
+                    _failed.append((item, attempts))
+                else:
+                    log.exception('Tell: dropping write-behind %s op %r after %s failed attempts',
+                                  item[0], item[1], attempts)
+                    self._drop([item])
+
+        if len(_failed) > self._max_pending:
+            log.error('Tell: dropping %s failed write-behind ops, more than %s are pending',
+                      len(_failed) - self._max_pending, self._max_pending)
+            self._drop([item for item, _ in _failed[:-self._max_pending]])
+            _failed = _failed[-self._max_pending:]
+        return _failed
+
+    def _drop(self, items):
+        if self._dropped is not None:
+            self._dropped(items)
@@ -29,16 +29,26 @@
 ###
 
 import datetime
+import itertools
+import threading
+import time
+import uuid
+from time import perf_counter
 
 import supybot.callbacks as callbacks
+import supybot.ircdb as ircdb
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.conf as conf
+import supybot.schedule as schedule
 from supybot.commands import *
 import os
-import humanize
 
 from .local.tell_db import TellDB
+from .local.tell_cache import LRUCache, LRUSet, CachedTell, Mailbox, to_epoch
+from .local.tell_format import compile_template, naturaltime, pack_items, pack_lines
+from .local.tell_delivery import Pacer, Timeline, parse_when
+from .local.tell_stats import STATS
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -52,79 +62,495 @@ except ImportError:
 # Used to query tells for users.
 class TellLib:
 
-    # to_nic => {'tells'=>[], 'delay'=>datetime.datetime}
+    # TellDB.nick_key(to_nick) => Mailbox of CachedTell
     unread_tells = {}
 
-    # Initial tell count (Or after reload)
+    # Striped locks guarding the mailboxes, a nick always maps to the same one. Reentrant since
+    # delivery holds it while calling back into query_post/messages_read.
+    _locks = [threading.RLock() for _ in range(64)]
+
+    # Held while load_unread rebuilds the cache or sync_unread applies changes. IDs flagged read
+    # meanwhile are collected in _read_during_refresh and dropped from the new cache.
+    _refresh_lock = threading.RLock()
+    _read_during_refresh = None
+    # New tells are stored outside the lock and only take it for the cache update. Every load or
+    # sync bumps _refresh_gen and records in _refreshed_id the highest ID it read, an insert that
+    # sees the generation move on leaves its tells up to that ID to the refresh.
+    _refresh_gen = 0
+    _refreshed_id = 0
+
+    # IDs taken out of their mailbox for a paced send that hasn't gone out yet. Still unread in
+    # the DB, so reloads must skip them.
+    in_flight = set()
+
+    # nick key => epoch time delaytells holds delivery back until. Filled from the DB on load,
+    # entries are dropped by the timeline when they run out.
+    delays = {}
+
+    # Expiry of delays and tells sent with `tell --at`. Rebuilt from the DB on every load, calls
+    # queued before that carry an older generation and are ignored.
+    timeline = Timeline('Tell.timeline')
+    _timeline_gen = 0
+    # IDs of the timed tells waiting on the timeline, a sync seeing one again leaves it there
+    _timed_ids = set()
+
+    # High-water marks of the last load or sync, (max ID, max Modified). sync_overlap seconds are
+    # read again on every sync, for writers with a slightly different clock or slow commits.
+    _sync_marks = None
+    sync_overlap = 5
+
+    # Shared mode: other bots use the same table. Tells are claimed before they're relayed, and
+    # their inserts and claims are picked up from the change log (past _change_mark) on sync.
+    shared = False
+    _change_mark = 0
+    change_log_ttl = 86400
+
+    # Tells in memory, kept up to date as they come and go
     tell_count = 0
+    _count_lock = threading.Lock()
+
+    # Lazy mode loads a nick's tells on first lookup into a bounded LRU instead of loading
+    # every unread tell up front. no_tells remembers nicks known to have nothing pending.
+    lazy = False
+    cache_size = 10000
+    negative_cache_size = 100000
+    no_tells = None
+    # Rows fetched at a time when loading every unread tell
+    load_chunk_size = 1000
+    # Prefetches running, and the nicks whose mail changed while they did. A prefetch leaves
+    # those alone, what it read from the DB may already be out of date for them.
+    _prefetches = 0
+    _prefetch_touched = set()
+    _prefetch_state = threading.Lock()
+
+    def lock_for(self, nick):
+        return self._locks[hash(TellDB.nick_key(nick)) % len(self._locks)]
+
+    def configure_shared(self, shared):
+        self.shared = shared
+        TellDB.configure_shared(uuid.uuid4().hex if shared else None)
+
+    def configure_cache(self, lazy, cache_size, negative_cache_size):
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.negative_cache_size = negative_cache_size
+
+    # Cheap check for inFilter: False only when the nick surely has nothing pending. In lazy
+    # mode a nick we know nothing about yet counts as maybe having mail.
+    def has_mail(self, user: str):
+        _key = TellDB.nick_key(user)
+        if _key in self.unread_tells:
+            return _key not in self.delays
+        return self.lazy and _key not in self.no_tells
+
+    def is_delayed(self, nick):
+        return TellDB.nick_key(nick) in self.delays
 
     # Query post (past) tells
     def query_post(self, user: str):
-        if user in self.unread_tells:
-            return self.unread_tells[user]
+        _key = TellDB.nick_key(user)
+        if _key in self.unread_tells:
+            return self.unread_tells[_key]
+        elif not self.lazy or _key in self.no_tells:
+            return None
         else:
+            return self._load_nick(_key, user)
+
+    def _load_nick(self, key, nick):
+        _records = TellDB.query_unread_for(nick)
+        if not _records:
+            self.no_tells.add(key)
             return None
 
-    def flag_all_read(self, nick):
-        _tells = self.unread_tells.copy()
+        for record in _records:
+            if record.ID not in self.in_flight:
+                self._add_tell(key, CachedTell.from_record(record))
+        return self.unread_tells.get(key)
 
-        if nick not in _tells:
-            return
+    # Lazy mode: fill the mailboxes of several nicks with one query, for nicks that joined or
+    # changed nick and will likely speak soon. Nicks already in the cache, or known to have
+    # nothing, are skipped. Returns the number of nicks looked up.
+    def prefetch(self, nicks):
+        if not self.lazy:
+            return 0
+        _nicks = {}
+        for nick in nicks:
+            _key = TellDB.nick_key(nick)
+            if _key not in self.unread_tells and _key not in self.no_tells:
+                _nicks[_key] = nick
+        if not _nicks:
+            return 0
 
-        for i in _tells[nick]['tells']:
-            _id = i['id']
+        # The query runs without any mailbox lock. Tells sent or read meanwhile mark their nick
+        # touched, and the fill skips those, their next lookup loads them from the DB.
+        with self._prefetch_state:
+            self._prefetches += 1
+        try:
+            _found = {}
+            for record in TellDB.query_unread_for_many(list(_nicks.values())):
+                _found.setdefault(TellDB.nick_key(record.ToNick), []).append(record)
+
+            for _key in _nicks:
+                with self.lock_for(_key):
+                    if _key in self.unread_tells or _key in self.no_tells or _key in self._prefetch_touched:
+                        continue
+                    if _key not in _found:
+                        self.no_tells.add(_key)
+                        continue
+                    for record in _found[_key]:
+                        if record.ID not in self.in_flight:
+                            self._add_tell(_key, CachedTell.from_record(record))
+        finally:
+            with self._prefetch_state:
+                self._prefetches -= 1
+                if not self._prefetches:
+                    self._prefetch_touched = set()
+        return len(_nicks)
+
+    # Tells of key changed, a prefetch running now must not fill its mailbox from older rows.
+    # Tells reach the DB before this is called, so a prefetch starting later reads them.
+    def _touch(self, key):
+        if self._prefetches:
+            self._prefetch_touched.add(key)
+
+    def _counted(self, n):
+        with self._count_lock:
+            self.tell_count += n
+
+    # A lazy mailbox fell out of the LRU, its tells are no longer in memory
+    def _evicted(self, key, mailbox):
+        self._counted(-len(mailbox.tells))
+
+    def _add_tell(self, key, tell):
+        self._counted(1)
+        if key in self.unread_tells:
+            _mailbox = self.unread_tells[key]
+            _mailbox.tells.append(tell)
+            # New mail gets announced again even if the last page was cut short
+            _mailbox.paused = False
+        else:
+            self.unread_tells[key] = Mailbox([tell])
+
+    # New tell for to_nick. A lazy cache only takes it if the mailbox is already loaded, otherwise
+    # the next lookup will pick it up from the DB together with the rest.
+    def _new_tell(self, to_nick, tell):
+        _key = TellDB.nick_key(to_nick)
+        with self.lock_for(to_nick):
+            if self.lazy and _key not in self.unread_tells:
+                self.no_tells.discard(_key)
+                self._touch(_key)
+                return
+            _mailbox = self.unread_tells.get(_key)
+            # A lazy load or a sync may have read it from the DB already
+            if _mailbox is None or not _mailbox.has_tell(tell.id):
+                self._add_tell(_key, tell)
 
-            self.message_read(_id, nick, skip_index=True)
+    def flag_all_read(self, nick):
+        with self.lock_for(nick):
+            _tells = self.query_post(nick)
 
-        # Delete here after we have flagged in DB
-        del self.unread_tells[nick]
+            if _tells is None:
+                return
 
-    # Load all unread messages into memory
+            _ids = [i.id for i in _tells.tells]
+            if self.shared:
+                # Whatever we didn't get, another bot relayed already
+                TellDB.claim_tells(_ids)
+            self.messages_read(_ids, nick)
+
+    # Shared mode: flag tells read before relaying them, and return the ones this bot got. The
+    # others were relayed by another bot and are dropped.
+    def claim(self, tells, nick):
+        _claimed = set(TellDB.claim_tells([t.id for t in tells]))
+        STATS.count('claims_lost', len(tells) - len(_claimed))
+        self._drop_tells([t.id for t in tells if t.id not in _claimed], nick)
+        return [t for t in tells if t.id in _claimed]
+
+    # Load all unread messages into memory. The new cache is built on the side and swapped in,
+    # readers keep using the old one until then.
     def load_unread(self):
         # telrefresh, done...
-        self.unread_tells = {}
-        self.tell_count = 0
-        for record in TellDB.query_unread():
-            self.tell_count += 1
-            _r = {'id': record.ID, 'content': record.Content, 'time': record.Timestamp, 'private': record.Private,
-                  'from': record.FromNick}
-            if record.ToNick in self.unread_tells:
-                self.unread_tells[record.ToNick]['tells'].append(_r)
-            else:
-                self.unread_tells[record.ToNick] = {'tells': [_r], 'delay': None}
-
-    # Sync database and set a message to read
-    def message_read(self, tell_id, nick, skip_index=False):
-        TellDB.update_read(tell_id)
+        with self._refresh_lock:
+            # Rows written outside the bot may lack a nick key
+            TellDB.fill_nick_keys()
+
+            _now = time.time()
+            # Marks before the load, anything written meanwhile is left to its insert or the next sync
+            self._sync_marks = TellDB.sync_marks()
+            _max_id = self._sync_marks[0] or 0
+            if self.shared:
+                self._change_mark = TellDB.change_log_mark()
+            if self.lazy:
+                # Nothing up front, mailboxes get filled in by query_post
+                self.no_tells = LRUSet(self.negative_cache_size)
+                self.unread_tells = LRUCache(self.cache_size, self._evicted)
+                self.tell_count = 0
+                self._reset_timeline(_now, [r for r in TellDB.query_scheduled() if r.ID <= _max_id])
+                self._refreshed(_max_id)
+                return
 
-        if skip_index:
+            self._read_during_refresh = set()
+            try:
+                _cache = {}
+                _scheduled = []
+                # Tells sent to several nicks share one copy of their text
+                _texts = {}
+                _create = CachedTell.create
+                _nick_key = TellDB.nick_key
+                for record in TellDB.stream_unread(self.load_chunk_size):
+                    _id, _from, _to, _content, _private, _timestamp, _deliver_at = record
+                    if _id > _max_id:
+                        continue
+                    if _deliver_at is not None and to_epoch(_deliver_at) > _now:
+                        _scheduled.append(record)
+                        continue
+                    _key = _nick_key(_to)
+                    _content = _texts.setdefault(_content, _content)
+                    _tell = _create(_id, _content, _timestamp, _private, _from)
+                    if _key in _cache:
+                        _cache[_key].tells.append(_tell)
+                    else:
+                        _cache[_key] = Mailbox([_tell])
+
+                # Delivered while we were reading, or on their way out
+                _skip = self._read_during_refresh | self.in_flight
+                for _key in list(_cache):
+                    _mailbox = _cache[_key]
+                    _mailbox.tells = [t for t in _mailbox.tells if t.id not in _skip]
+                    if not _mailbox.tells:
+                        del _cache[_key]
+
+                self.unread_tells = _cache
+                self.tell_count = sum(len(m.tells) for m in _cache.values())
+
+                # Read between the filter and the swap, so only dropped from the old cache
+                _late = (self._read_during_refresh | self.in_flight) - _skip
+                if _late:
+                    for _key in list(_cache):
+                        with self.lock_for(_key):
+                            _mailbox = _cache.get(_key)
+                            if _mailbox is not None:
+                                self._drop_tells([t.id for t in _mailbox.tells if t.id in _late], _key)
+                self._reset_timeline(_now, _scheduled)
+                self._refreshed(_max_id)
+            finally:
+                self._read_during_refresh = None
+
+    # Apply what was written to the table since the last load or sync, instead of reading every
+    # unread tell again. Returns the number of changes applied.
+    def sync_unread(self):
+        with self._refresh_lock:
+            if self._sync_marks is None:
+                self.load_unread()
+                return self.tell_count
+            # Rows written outside the bot may lack nick keys, lookups and searches go by them
+            TellDB.fill_nick_keys()
+            if self.shared:
+                return self._sync_change_log()
+
+            _max_id, _modified = self._sync_marks
+            _since = _modified - datetime.timedelta(seconds=self.sync_overlap) if _modified is not None else None
+            self._read_during_refresh = set()
+            try:
+                _now = time.time()
+                _count = 0
+                _top_id = _max_id or 0
+                _top_modified = _modified
+                for record in TellDB.query_changes(_max_id, _since):
+                    if self._apply_change(record, record.ID > (_max_id or 0), _now):
+                        _count += 1
+                    _top_id = max(_top_id, record.ID)
+                    if record.Modified is not None and (_top_modified is None or record.Modified > _top_modified):
+                        _top_modified = record.Modified
+                self._sync_marks = (_top_id, _top_modified)
+                self._refreshed(_top_id)
+                return _count
+            finally:
+                self._read_during_refresh = None
+
+    def _refreshed(self, max_id):
+        self._refreshed_id = max_id
+        self._refresh_gen += 1
+
+    # Shared mode sync: apply the tells other bots inserted or claimed since the last one
+    def _sync_change_log(self):
+        self._read_during_refresh = set()
+        try:
+            _mark, _records = TellDB.query_change_log(self._change_mark)
+            _now = time.time()
+            _count = 0
+            for record in _records:
+                if self._apply_change(record, True, _now):
+                    _count += 1
+            self._change_mark = _mark
+        finally:
+            self._read_during_refresh = None
+
+        TellDB.prune_change_log(datetime.datetime.now() - datetime.timedelta(seconds=self.change_log_ttl))
+        return _count
+
+    # Bring the cache in line with one changed row. Rows come back more than once (see
+    # sync_overlap), so this only changes anything when the cache disagrees with the row.
+    def _apply_change(self, record, new, now):
+        if record.ID in self.in_flight:
+            return False
+
+        _key = TellDB.nick_key(record.ToNick)
+        with self.lock_for(_key):
+            _mailbox = self.unread_tells.get(_key)
+            _cached = _mailbox is not None and _mailbox.has_tell(record.ID)
+
+            # Flagged read elsewhere, or delivered by us since the query ran
+            if record.Read or record.ID in self._read_during_refresh:
+                if _cached:
+                    self._drop_tells([record.ID], _key)
+                return _cached
+
+            if _cached:
+                return False
+            if record.DeliverAt is not None and to_epoch(record.DeliverAt) > now:
+                if not new or record.ID in self._timed_ids:
+                    return False
+                self._add_timed(self._timeline_gen, record.ToNick, CachedTell.from_record(record),
+                                to_epoch(record.DeliverAt))
+            else:
+                self._new_tell(record.ToNick, CachedTell.from_record(record))
+            return True
+
+    # Start the timeline over with the delays from the DB and the given timed tells
+    def _reset_timeline(self, now, scheduled):
+        self.timeline.clear()
+        self._timeline_gen += 1
+        _gen = self._timeline_gen
+        self._timed_ids = set()
+
+        _delays = {}
+        for key, until in TellDB.query_delays():
+            _delays[key] = to_epoch(until)
+            self.timeline.add(_delays[key], self._delay_over, key, _delays[key])
+        self.delays = _delays
+
+        for record in scheduled:
+            if record.ID not in self.in_flight:
+                self._add_timed(_gen, record.ToNick, CachedTell.from_record(record), to_epoch(record.DeliverAt))
+
+    def _add_timed(self, gen, to_nick, tell, when):
+        self._timed_ids.add(tell.id)
+        self.timeline.add(when, self._tell_due, gen, to_nick, tell)
+
+    def _delay_over(self, key, until):
+        with self.lock_for(key):
+            if self.delays.get(key) == until:
+                del self.delays[key]
+
+    # A timed tell is due, it joins the nick's mailbox like a new one
+    def _tell_due(self, gen, to_nick, tell):
+        with self._refresh_lock:
+            if gen != self._timeline_gen:
+                return
+            self._timed_ids.discard(tell.id)
+            self._new_tell(to_nick, tell)
+
+    # Flag a batch of a nick's tells read in one transaction, then drop them from memory
+    def messages_read(self, tell_ids, nick):
+        # Claimed in shared mode, already flagged
+        if not self.shared:
+            TellDB.update_read_many(tell_ids)
+        STATS.count('tells_read', len(tell_ids))
+
+        # Only delete after the DB commit went through, otherwise the tells stay pending
+        _refreshing = self._read_during_refresh
+        if _refreshing is not None:
+            _refreshing.update(tell_ids)
+        self._drop_tells(tell_ids, nick)
+
+    # Take tells out of the mailbox ahead of a paced send. They stay unread in the DB until
+    # messages_sent is called for them.
+    def take_tells(self, tell_ids, nick):
+        self.in_flight.update(tell_ids)
+        self._drop_tells(tell_ids, nick)
+
+    # Paced send went out, flag its tells read
+    def messages_sent(self, tell_ids):
+        try:
+            if not self.shared:
+                TellDB.update_read_many(tell_ids)
+            STATS.count('tells_read', len(tell_ids))
+            _refreshing = self._read_during_refresh
+            if _refreshing is not None:
+                _refreshing.update(tell_ids)
+        finally:
+            self.in_flight.difference_update(tell_ids)
+
+    # Paced sends dropped before they went out. Shared mode flagged their tells read when it
+    # claimed them, hand those back so they aren't lost.
+    def release_in_flight(self):
+        _ids = list(self.in_flight)
+        self.in_flight.difference_update(_ids)
+        if self.shared:
+            TellDB.release_claims(_ids)
+
+    def _drop_tells(self, tell_ids, nick):
+        if not tell_ids:
             return
-        else:
-            del self.unread_tells[nick]
 
-    def set_delay(self, nick, delay):
-        if nick in self.unread_tells:
-            self.unread_tells[nick]['delay'] = delay
-
-    # TellDB.insert_tell(msg.nick, i, message, self.pm, _dt)
-    def insert_tell(self, from_nick, to_nick, message, private, time):
-        record_id = TellDB.insert_tell(from_nick, to_nick, message, private, time)
+        _key = TellDB.nick_key(nick)
+        self._touch(_key)
+        _mailbox = self.unread_tells.get(_key)
+        if _mailbox is None:
+            return
 
-        _r = {'id': record_id, 'content': message, 'time': time, 'private': private, 'from': from_nick}
+        _ids = set(tell_ids)
+        _before = len(_mailbox.tells)
+        _mailbox.tells = [t for t in _mailbox.tells if t.id not in _ids]
+        self._counted(len(_mailbox.tells) - _before)
+        if not _mailbox.tells:
+            self.unread_tells.pop(_key, None)
+            if self.lazy:
+                self.no_tells.add(_key)
 
-        if to_nick in self.unread_tells:
-            self.unread_tells[to_nick]['tells'].append(_r)
-        else:
-            self.unread_tells[to_nick] = {'tells': [_r], 'delay': None}
+    # Hold nick's tells back until delay, also ones that haven't been sent yet. None lifts it.
+    def set_delay(self, nick, delay):
+        _key = TellDB.nick_key(nick)
+        with self.lock_for(nick):
+            TellDB.set_delay(nick, delay)
+            if delay is None:
+                self.delays.pop(_key, None)
+                return
+            _until = self.delays[_key] = to_epoch(delay)
+        self.timeline.add(_until, self._delay_over, _key, _until)
+
+    # Same tell for several nicks, stored with one batch insert. With deliver_at it only shows up
+    # in their mailboxes from then on.
+    def insert_tells(self, from_nick, to_nicks, message, private, time, deliver_at=None):
+        _gen = self._refresh_gen
+        record_ids = TellDB.insert_tells(from_nick, to_nicks, message, private, time, deliver_at)
+        STATS.count('tells_inserted', len(record_ids))
+
+        # `time` is when the tell was written, so anything later is still in the future
+        _later = deliver_at is not None and deliver_at > time
+        with self._refresh_lock:
+            # A load or sync since the insert read them from the DB already
+            _covered = self._refreshed_id if self._refresh_gen != _gen else 0
+            for to_nick, record_id in zip(to_nicks, record_ids):
+                if record_id <= _covered:
+                    continue
+                _tell = CachedTell.create(record_id, message, time, private, from_nick)
+                if _later:
+                    self._add_timed(self._timeline_gen, to_nick, _tell, to_epoch(deliver_at))
+                else:
+                    self._new_tell(to_nick, _tell)
 
     def get_tell_count(self):
         return self.tell_count
 
     def get_user_tell_count(self, nick):
-        if nick in self.unread_tells:
-            return len(self.unread_tells[nick])
-        else:
-            return 0
+        with self.lock_for(nick):
+            _tells = self.query_post(nick)
+            if _tells is not None:
+                return len(_tells.tells)
+            else:
+                return 0
 
 
 class Tell(callbacks.Plugin):
@@ -138,155 +564,652 @@ class Tell(callbacks.Plugin):
 
     queryTell = TellLib()
 
-    pm = 0
-
     # Commands that won't query tells
-    no_tells = ['delaytells', 'skiptells']
+    no_tells = ['delaytells', 'skiptells', 'moretells']
+
+    # Message templates from config, compiled by get_templates
+    template_names = ('you_have_mail', 'you_have_private_mail', 'tell_message', 'tell_refresh', 'tell_skip',
+                      'more_tells')
 
     def __init__(self, irc):
         self.__parent = super(Tell, self)
         self.__parent.__init__(irc)
 
+        TellDB.set_casemapping(self.registryValue('casemapping'))
+        TellDB.configure_engine(
+            self.registryValue('database') or None,
+            self.registryValue('pool.size'),
+            self.registryValue('pool.max_overflow'),
+            self.registryValue('pool.recycle'),
+            self.registryValue('pool.pre_ping'))
+        _applied = TellDB.migrate()
+        if _applied:
+            self.log.info('Tell: applied schema migrations %s', _applied)
+
+        self.queryTell.configure_shared(self.registryValue('shared'))
+        TellDB.configure_normalize(self.registryValue('normalize'))
+        if self.registryValue('write_behind') and self.queryTell.shared:
+            self.log.warning('Tell: write_behind is not used in shared mode')
+        elif self.registryValue('write_behind'):
+            TellDB.start_write_behind(
+                self.registryValue('write_behind.queue_size'),
+                self.registryValue('write_behind.batch_size'),
+                self.registryValue('write_behind.interval'))
+
+        self.queryTell.configure_cache(
+            self.registryValue('lazy_load'),
+            self.registryValue('lazy_load.cache_size'),
+            self.registryValue('lazy_load.negative_cache_size'))
         self.queryTell.load_unread()
 
-        # Build the list for no tells
-        self.bypass_tell_query = []
-        _chars = conf.supybot.reply.whenAddressedBy.chars()
-        _chars = _chars.split(',')
+        # Pick up tells written by other tools every sync_interval seconds
+        self._sync_interval = self.registryValue('sync_interval')
+        if self._sync_interval:
+            schedule.addPeriodicEvent(self.sync_tells, self._sync_interval, 'Tell.sync', now=False)
+
+        # Purge read tells past retention.days every retention.interval seconds, in a thread
+        self._retention_lock = threading.Lock()
+        self._retention_interval = self.registryValue('retention.interval')
+        if self._retention_interval:
+            schedule.addPeriodicEvent(self.retention_tells, self._retention_interval, 'Tell.retention', now=False)
+
+        # Numbers for tellstats and the Prometheus file
+        self._infilter_time = STATS.histogram('infilter')
+        self._delivery_time = STATS.histogram('delivery')
+        _lib = self.queryTell
+        STATS.gauge('pending', lambda: _lib.tell_count)
+        STATS.gauge('mailboxes', lambda: len(_lib.unread_tells))
+        STATS.gauge('scheduled', lambda: len(_lib.timeline))
+        STATS.gauge('delayed', lambda: len(_lib.delays))
+        STATS.gauge('in_flight', lambda: len(_lib.in_flight))
+        self._prometheus_interval = self.registryValue('stats.prometheus_interval') \
+            if self.registryValue('stats.prometheus_file') else 0
+        if self._prometheus_interval:
+            schedule.addPeriodicEvent(self.write_prometheus, self._prometheus_interval, 'Tell.prometheus')
+
+        # Per-target pacing of delivered lines, and the paced sends still waiting in schedule
+        self.pacer = Pacer(self.registryValue('delivery.rate'), self.registryValue('delivery.burst'))
+        self._send_ids = itertools.count()
+        self._scheduled = set()
+
+        # Nicks waiting for the next prefetch batch, nick => JOIN message to deliver private tells
+        # for, or None
+        self._prefetch_queue = {}
+        self._prefetch_lock = threading.Lock()
+
+        # Compiled templates, dropped whenever one of them is changed in the registry
+        self._templates = None
+        self._templates_changed = self.reset_templates
+        for name in self.template_names:
+            conf.supybot.plugins.Tell.get(name).addCallback(self._templates_changed)
+
+        # Build the set for no tells. whenAddressedBy.chars is a string of prefix characters.
+        self.bypass_tell_query = set()
+        _chars = [c for c in conf.supybot.reply.whenAddressedBy.chars() if c not in ', ']
         for i in self.no_tells:
-            self.bypass_tell_query.append(i)
+            self.bypass_tell_query.add(i)
             for c in _chars:
-                self.bypass_tell_query.append("%s%s" % (c, i))
+                self.bypass_tell_query.add("%s%s" % (c, i))
+        # Longest first word that can possibly be a bypass command
+        self.bypass_max_len = max(len(i) for i in self.bypass_tell_query)
 
-    def get_timeago(self, t):
-        return humanize.naturaltime(datetime.datetime.now() - t['time'])
+    def die(self):
+        # Paced sends that haven't gone out stay unread in the DB, or are made unread again
+        for name in list(self._scheduled):
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+        try:
+            self.queryTell.release_in_flight()
+        except Exception:
+            self.log.exception('Tell: could not hand back claimed tells that were never sent')
+        for name, interval in (('Tell.sync', self._sync_interval), ('Tell.retention', self._retention_interval),
+                               ('Tell.prometheus', self._prometheus_interval)):
+            if interval:
+                try:
+                    schedule.removePeriodicEvent(name)
+                except KeyError:
+                    pass
+        try:
+            schedule.removeEvent('Tell.prefetch')
+        except KeyError:
+            pass
+        # Delays and timed tells are in the DB, the next load picks them up again
+        self.queryTell.timeline.clear()
+        # Drain queued writes before we get unloaded/reloaded
+        TellDB.stop_write_behind()
+        # The engine outlives us in its holder, a reload reconnects on first use
+        TellDB.dispose()
+        for name in self.template_names:
+            conf.supybot.plugins.Tell.get(name).removeCallback(self._templates_changed)
+        self.__parent.die()
+
+    def reset_templates(self):
+        self._templates = None
+
+    # name => compiled Template, plus 'render_tell' which renders tell_message for (CachedTell, now).
+    # Values were checked when they were set, so compiling can't fail here.
+    def get_templates(self):
+        _templates = self._templates
+        if _templates is None:
+            _templates = {}
+            for name in self.template_names:
+                _value = conf.supybot.plugins.Tell.get(name)
+                _templates[name] = compile_template(_value(), tuple(_value.samples))
+
+            # This will tie to config, tellMessage. If you want to add more variables, do it here.
+            _templates['render_tell'] = _templates['tell_message'].bind({
+                'time_ago': self.get_timeago,
+                'from': lambda t, now: t.sender,
+                'content': lambda t, now: t.content,
+            })
+            self._templates = _templates
+        return _templates
+
+    # Pass `now` when formatting a batch, so the clock is only read once for all of them
+    def get_timeago(self, t, now=None):
+        if now is None:
+            now = time.time()
+        return naturaltime(now - t.time)
+
+    # Someone joined: warm their mailbox before they speak, and with delivery.on_join send their
+    # private tells right away
+    def doJoin(self, irc, msg):
+        if ircutils.strEqual(msg.nick, irc.nick):
+            return
+        self.queue_prefetch(irc, msg.nick, msg if self.registryValue('delivery.on_join') else None)
 
-    # Process all text before handing off to command processor
+    def doNick(self, irc, msg):
+        self.queue_prefetch(irc, msg.args[0], None)
+
+    # Look the nick up in the next prefetch batch. Batches go out lazy_load.prefetch_delay after
+    # their first nick, so the joins of a netsplit coming back share one query. join is the JOIN
+    # to deliver private tells for once the mailbox is in, if any.
+    def queue_prefetch(self, irc, nick, join):
+        _lib = self.queryTell
+        if not _lib.has_mail(nick):
+            return
+        if not _lib.lazy or TellDB.nick_key(nick) in _lib.unread_tells:
+            if join is not None:
+                self.deliver_tells(irc, join, nick, private_only=True)
+            return
+        if join is None and not self.registryValue('lazy_load.prefetch'):
+            return
+
+        with self._prefetch_lock:
+            _first = not self._prefetch_queue
+            if join is not None or nick not in self._prefetch_queue:
+                self._prefetch_queue[nick] = (irc, join)
+        if _first:
+            schedule.addEvent(self.run_prefetch, time.time() + self.registryValue('lazy_load.prefetch_delay'),
+                              'Tell.prefetch')
+
+    # One query for the queued nicks, in a thread so inFilter isn't held up by it
+    def run_prefetch(self):
+        with self._prefetch_lock:
+            _queue = self._prefetch_queue
+            self._prefetch_queue = {}
+
+        def run():
+            try:
+                _count = self.queryTell.prefetch(list(_queue))
+                STATS.count('prefetched', _count)
+                for nick, (irc, join) in _queue.items():
+                    if join is not None:
+                        self.deliver_tells(irc, join, nick, private_only=True)
+            except Exception:
+                self.log.exception('Tell: prefetch failed')
+            finally:
+                TellDB.end_session()
+
+        threading.Thread(target=run, name='Tell prefetch', daemon=True).start()
+
+    # Process all text before handing off to command processor. Runs for every inbound message,
+    # so the common case (no mail) returns after a command check and a cache lookup. The time
+    # spent goes to the infilter histogram.
     def inFilter(self, irc, msg):
+        _start = perf_counter()
+        try:
+            return self._filter(irc, msg)
+        finally:
+            self._infilter_time.observe(perf_counter() - _start)
+
+    def _filter(self, irc, msg):
+        if msg.command != "PRIVMSG" or not self.queryTell.has_mail(msg.nick):
+            return msg
+
+        _channel = msg.args[0]
+
+        # Relay when talking in a channel or sending PM to bot
+        if _channel != irc.nick and not ircutils.isChannel(_channel) and _channel != 'test':
+            return msg
+
         # If !delaytells is the command, obviously don't relay tells.
         # Test environment strips the ! for some odd fucking reason...
-        if msg.args[1].split(' ')[0] in self.bypass_tell_query:
+        _text = msg.args[1]
+        _end = _text.find(' ')
+        if _end == -1:
+            _end = len(_text)
+        if _end <= self.bypass_max_len and _text[:_end] in self.bypass_tell_query:
             return msg
 
-        # Attempt to query any past tells for the user.
-        if msg.command == "PRIVMSG":
-            tells = self.queryTell.query_post(msg.nick)
-            _channel = msg.args[0]
-
-            # Sending PM to bot?
-            if _channel == irc.nick:
-                self.pm = True
-            else:
-                # Check that we have a valid channel
-                if not ircutils.isChannel(_channel) and _channel != 'test':
-                    return msg
-                self.pm = False
-
-            # Process any tells for the user when they type
-            if tells is not None:
-                # First check if we have a delay.
-                if tells['delay'] is not None:
-                    _now = datetime.datetime.now()
-                    try:
-                        if _now < tells['delay']:
-                            # Don't relay tells. We haven't passed the delay time
-                            return msg
-                    except:
-                        pass
-
-                _public = self.registryValue('you_have_mail')
-                _private = self.registryValue('you_have_private_mail')
-                _message = self.registryValue("tell_message")
-                _priv_tells = []
-                _pub_tells = []
-                _relay_pub = False
-                _relay_private = False
-                _priv_count = 0
-                _pub_count = 0
-                # Format and divvy out private and public tells.
-                for t in tells['tells']:
-                    # Set the Tell to read
-                    _id = t['id']
-                    self.queryTell.message_read(_id, msg.nick)
-                    # This will tie to config, tellMessage. If you want to add more variables, do it here.
-                    _d = {'time_ago': self.get_timeago(t), 'from': t['from'], 'content': t['content']}
-                    if t['private'] is True:
-                        _priv_count += 1
-                        _relay_private = True
-                        _priv_tells.append(_message.format(**_d))
-                    elif t['private'] is False:
-                        _pub_count += 1
-                        _relay_pub = True
-                        _pub_tells.append(_message.format(**_d))
-
-                # Relay public tells
-                if _relay_pub:
-                    _m = _public.format(**{
-                        'to': msg.nick,
-                        'pub_count': _pub_count,
-                        'plural': "s" if _pub_count > 1 else ''
-                    })
-                    irc.queueMsg(ircmsgs.notice(_channel, _m))
-
-                    for m in _pub_tells:
-                        irc.queueMsg(ircmsgs.notice(_channel, m))
-
-                # Relay private tells
-                if _relay_private:
-                    _m = _private.format(**{
-                        'to': msg.nick,
-                        'priv_count': _priv_count,
-                        'plural': "s" if _priv_count > 1 else ''
-                    })
-                    irc.queueMsg(ircmsgs.notice(msg.nick, _m))
-
-                    for m in _priv_tells:
-                        irc.queueMsg(ircmsgs.notice(msg.nick, m))
+        # Process any tells for the user when they type
+        self.deliver_tells(irc, msg, _channel)
         return msg
 
-    def tell(self, irc, msg, args, now, nicks, message):
-        """<user1,user2> <message>
+    # Relay a nick's pending tells. Runs under the nick's lock, so a threaded command or a second
+    # message from the same nick can't deliver or change the mailbox halfway through. With
+    # more=True (moretells) a delay or a paused mailbox doesn't hold the next page back.
+    # private_only (delivery.on_join) leaves the public ones for when the nick speaks.
+    def deliver_tells(self, irc, msg, channel, more=False, private_only=False):
+        _start = perf_counter()
+        try:
+            return self._deliver_tells(irc, msg, channel, more, private_only)
+        finally:
+            self._delivery_time.observe(perf_counter() - _start)
+
+    def _deliver_tells(self, irc, msg, channel, more, private_only):
+        with self.queryTell.lock_for(msg.nick):
+            tells = self.queryTell.query_post(msg.nick)
+            if tells is None:
+                return False
+
+            if not more:
+                # Don't relay tells while delaytells is holding them back
+                if self.queryTell.is_delayed(msg.nick):
+                    return False
+
+                # Last page was cut short, the rest waits for moretells
+                if tells.paused:
+                    return False
+
+            # Talking to the bot directly, so answer there rather than notice ourselves
+            if channel == irc.nick:
+                channel = msg.nick
+
+            _candidates = [t for t in tells.tells if t.private] if private_only else tells.tells
+            if not _candidates:
+                return False
+
+            # Only one page per activation when delivery.max_per_activation is set
+            _limit = self.registryValue('delivery.max_per_activation')
+            _page = _candidates[:_limit] if _limit else list(_candidates)
+
+            # Other bots on the table may have relayed some of these already
+            if self.queryTell.shared:
+                _page = self.queryTell.claim(_page, msg.nick)
+                if not _page:
+                    return False
+            _rest = (sum(1 for t in tells.tells if t.private) if private_only else len(tells.tells)) - len(_page)
+
+            _templates = self.get_templates()
+            _render = _templates['render_tell']
+            _now = time.time()
+            _priv_tells = []
+            _pub_tells = []
+            _priv_ids = []
+            _pub_ids = []
+            # Format and divvy out private and public tells.
+            for t in _page:
+                if t.private is True:
+                    _priv_tells.append(_render(t, _now))
+                    _priv_ids.append(t.id)
+                elif t.private is False:
+                    _pub_tells.append(_render(t, _now))
+                    _pub_ids.append(t.id)
+
+            # (target, text, ids of the tells that are complete once this line is out)
+            _lines = []
+
+            # Relay public tells
+            if _pub_tells:
+                _m = _templates['you_have_mail'](
+                    to=msg.nick,
+                    pub_count=len(_pub_tells),
+                    plural="s" if len(_pub_tells) > 1 else ''
+                )
+                _lines += self.notice_lines(irc, channel, _m, _pub_tells, _pub_ids)
+
+            # Relay private tells
+            if _priv_tells:
+                _m = _templates['you_have_private_mail'](
+                    to=msg.nick,
+                    priv_count=len(_priv_tells),
+                    plural="s" if len(_priv_tells) > 1 else ''
+                )
+                _lines += self.notice_lines(irc, msg.nick, _m, _priv_tells, _priv_ids)
+
+            if _rest:
+                _lines.append((msg.nick, _templates['more_tells'](count=_rest, plural="s" if _rest > 1 else ''), []))
+
+            self.send_lines(irc, msg.nick, _lines)
+            if _rest:
+                tells.paused = True
+            return True
+
+    # Lines for a header plus tells to one target: one NOTICE per line, or packed into as few
+    # as fit when pack_notices is on
+    def notice_lines(self, irc, target, header, lines, ids):
+        _items = [header] + lines
+        _ids = [[]] + [[i] for i in ids]
+        if not self.registryValue('pack_notices'):
+            return [(target, text, i) for text, i in zip(_items, _ids)]
+
+        _packed = pack_items(_items, self.notice_budget(irc, target), self.registryValue('pack_notices.separator'))
+        return [(target, text, [i for index in ends for i in _ids[index]]) for text, ends in _packed]
+
+    # Send lines for nick's tells through the per-target token buckets. What can go out now is
+    # flagged read first, so nothing is sent if that fails. The rest is taken out of the mailbox
+    # and scheduled, its tells are flagged read once they have actually been sent.
+    def send_lines(self, irc, nick, lines):
+        _now = time.time()
+        _send_now = []
+        _read_now = []
+        _later = []
+        for target, text, ids in lines:
+            _wait = self.pacer.reserve(target, _now)
+            if _wait <= 0:
+                _send_now.append(ircmsgs.notice(target, text))
+                _read_now += ids
+            else:
+                _later.append((_now + _wait, ircmsgs.notice(target, text), ids))
+
+        self.queryTell.messages_read(_read_now, nick)
+        self.queryTell.take_tells([i for _, _, ids in _later for i in ids], nick)
+
+        STATS.count('lines_sent', len(_send_now))
+        for m in _send_now:
+            irc.queueMsg(m)
+        for when, m, ids in _later:
+            self._schedule_send(irc, m, ids, when)
+
+    def _schedule_send(self, irc, m, ids, when):
+        _name = 'Tell.send.%s' % next(self._send_ids)
+
+        def send():
+            self._scheduled.discard(_name)
+            STATS.count('lines_sent')
+            irc.queueMsg(m)
+            if ids:
+                self.queryTell.messages_sent(ids)
+
+        self._scheduled.add(_name)
+        schedule.addEvent(send, when, _name)
+
+    # Bytes of text that fit in a NOTICE to target, once the server relays it to clients as
+    # ':nick!user@host NOTICE target :text\r\n' within the 512 byte limit
+    @staticmethod
+    def notice_budget(irc, target):
+        _prefix = irc.prefix
+        _nick, _user, _host = ircutils.splitHostmask(_prefix)
+        # Host not known yet, leave room for the longest one a server will hand out
+        if _host == 'unset.domain':
+            _prefix = ircutils.joinHostmask(_nick, _user, 'h' * 63)
+        _line = str(ircmsgs.IrcMsg(prefix=_prefix, msg=ircmsgs.notice(target, '')))
+        return 512 - len(_line.encode('utf-8'))
+
+    def tell(self, irc, msg, args, now, opts, nicks, message):
+        """[--at <when>] <user1,user2> <message>
     
-        Saves a tell for the specified nicks.
+        Saves a tell for the specified nicks. With --at it isn't delivered before <when>, either
+        a duration like 1h30m or a local date/time like 2017-05-01T18:00.
         """
         tell_to = nicks.split(',')
 
-        # Insert tell records per each nick name
+        _at = None
+        for (opt, arg) in opts:
+            if opt == 'at':
+                try:
+                    _at = parse_when(arg)
+                except ValueError as e:
+                    irc.error(str(e))
+                    return
+
+        # Tells saved by PM to the bot are private. Worked out from the message itself, a flag
+        # set by inFilter could already belong to another message under threaded dispatch.
+        _private = not ircutils.isChannel(msg.args[0])
+
+        # Insert tell records for all nick names in one go
         _dt = datetime.datetime.now()
-        for i in tell_to:
-            self.queryTell.insert_tell(msg.nick, i, message, self.pm, _dt)
+        self.queryTell.insert_tells(msg.nick, tell_to, message, _private, _dt, _at)
 
-        irc.queueMsg(ircmsgs.notice(msg.nick, "Saving tell '" + message + "' for " + nicks))
-    tell = wrap(tell, ['now', 'somethingWithoutSpaces', 'text'])
+        _when = " to deliver after " + _at.strftime('%Y-%m-%d %H:%M') if _at is not None else ""
+        irc.queueMsg(ircmsgs.notice(msg.nick, "Saving tell '" + message + "' for " + nicks + _when))
+    tell = wrap(tell, ['now', getopts({'at': 'something'}), 'somethingWithoutSpaces', 'text'])
 
     def skiptells(self, irc, msg, args):
         """
         Skip all tells and set to Read.
         """
         _count = self.queryTell.get_user_tell_count(msg.nick)
-        _message = self.registryValue("tell_skip")
+        _message = self.get_templates()['tell_skip']
         self.queryTell.flag_all_read(msg.nick)
 
-        irc.queueMsg(ircmsgs.notice(msg.nick, _message.format(**{"count": _count})))
+        irc.queueMsg(ircmsgs.notice(msg.nick, _message(count=_count)))
 
     skiptells = wrap(skiptells, [])
 
-    def tellrefresh(self, irc, msg, args):
+    def moretells(self, irc, msg, args):
         """
-        Refresh the unread tells from Database
+        Deliver the next page of tells held back by delivery.max_per_activation.
         """
+        if not self.deliver_tells(irc, msg, msg.args[0], more=True):
+            irc.queueMsg(ircmsgs.notice(msg.nick, "No more tells."))
 
-        self.queryTell.load_unread()
-        _r = self.registryValue("tell_refresh")
+    moretells = wrap(moretells, [])
+
+    def tellrefresh(self, irc, msg, args, opts):
+        """[--full]
+
+        Pick up tells written to the Database by other tools since the last refresh. With --full
+        the unread tells are all read again.
+        """
+
+        if ('full', True) in opts:
+            self.queryTell.load_unread()
+            _count = self.queryTell.get_tell_count()
+        else:
+            _count = self.queryTell.sync_unread()
+        _r = self.get_templates()['tell_refresh']
         irc.queueMsg(ircmsgs.notice(
                 msg.nick,
-                _r.format(**{'count': self.queryTell.get_tell_count()})
+                _r(count=_count)
             )
         )
 
         return True
 
-    tellrefresh = wrap(tellrefresh, ['admin'])
+    tellrefresh = wrap(tellrefresh, ['admin', getopts({'full': ''})])
+
+    def tellpurge(self, irc, msg, args, opts, days):
+        """[--archive] [--compact] [<days>]
+
+        Delete read tells older than <days> (default retention.days), copying them to the archive
+        table with --archive, and compact the database afterwards with --compact. Reports the
+        rows purged and the time it took.
+        """
+        _opts = dict(opts)
+        if days is None:
+            days = self.registryValue('retention.days')
+        if not days:
+            irc.error('Set retention.days or give a number of days.')
+            return
+        if not self._retention_lock.acquire(False):
+            irc.error('A purge is already running.')
+            return
+        try:
+            _count, _purged, _compacted = self.run_retention(
+                days,
+                'archive' in _opts or self.registryValue('retention.archive'),
+                'compact' in _opts or self.registryValue('retention.compact'))
+        finally:
+            self._retention_lock.release()
+
+        _m = "Purged %d read tell%s older than %d day%s in %.2fs" % (
+            _count, 's' if _count != 1 else '', days, 's' if days != 1 else '', _purged)
+        if _compacted is not None:
+            _m += ", compacted in %.2fs" % _compacted
+        irc.queueMsg(ircmsgs.notice(msg.nick, _m + "."))
+
+    tellpurge = wrap(tellpurge, ['admin', getopts({'archive': '', 'compact': ''}), optional('nonNegativeInt')])
+
+    # Purge read tells older than `days`, then compact the database if asked. Returns
+    # (rows purged, seconds purging, seconds compacting or None).
+    def run_retention(self, days, archive, compact):
+        _start = time.time()
+        _before = datetime.datetime.now() - datetime.timedelta(days=days)
+        _count = TellDB.purge_read(_before, archive, self.registryValue('retention.chunk_size'))
+        _purged = time.time() - _start
+
+        _compacted = None
+        if compact:
+            _start = time.time()
+            if TellDB.compact():
+                _compacted = time.time() - _start
+        return _count, _purged, _compacted
+
+    # Periodic retention run, in a thread of its own so chunked deletes and VACUUM don't hold up
+    # the bot. Skipped while the previous one (or tellpurge) is still going. With normalize set it
+    # also moves the text of tells written since the last run to tell_message.
+    def retention_tells(self):
+        _days = self.registryValue('retention.days')
+        if not (_days or TellDB.normalize) or not self._retention_lock.acquire(False):
+            return
+
+        def run():
+            try:
+                if TellDB.normalize:
+                    _moved = TellDB.normalize_tells(self.registryValue('retention.chunk_size'))
+                    if _moved:
+                        self.log.info('Tell: moved the text of %d tells to tell_message', _moved)
+                if _days:
+                    _count, _purged, _compacted = self.run_retention(
+                        _days, self.registryValue('retention.archive'), self.registryValue('retention.compact'))
+                    self.log.info('Tell: purged %d read tells in %.2fs%s', _count, _purged,
+                                  ', compacted in %.2fs' % _compacted if _compacted is not None else '')
+            except Exception:
+                self.log.exception('Tell: retention run failed')
+            finally:
+                TellDB.end_session()
+                self._retention_lock.release()
+
+        threading.Thread(target=run, name='Tell retention', daemon=True).start()
+
+    def tellstats(self, irc, msg, args):
+        """takes no arguments
+
+        Pending tells, counters and latencies of inFilter, delivery and the database calls.
+        """
+        _items = ['%s: %s' % (name, f()) for name, f in sorted(STATS.gauges.items())]
+        _items += ['%s: %d' % (name, value) for name, value in sorted(STATS.counters.items())]
+        # Busiest first
+        for name, h in sorted(STATS.histograms.items(), key=lambda i: -i[1].sum):
+            if h.count:
+                _items.append('%s: %d calls, %s total, p50 %s, p99 %s, max %s' % (
+                    name, h.count, self.format_seconds(h.sum), self.format_seconds(h.quantile(0.5)),
+                    self.format_seconds(h.quantile(0.99)), self.format_seconds(h.max)))
+
+        for line in pack_lines(_items, self.notice_budget(irc, msg.nick), ' | '):
+            irc.queueMsg(ircmsgs.notice(msg.nick, line))
+
+    tellstats = wrap(tellstats, ['admin'])
+
+    @staticmethod
+    def format_seconds(seconds):
+        if seconds < 1e-3:
+            return '%.0fus' % (seconds * 1e6)
+        if seconds < 1:
+            return '%.1fms' % (seconds * 1e3)
+        return '%.2fs' % seconds
+
+    def write_prometheus(self):
+        try:
+            STATS.write_prometheus(self.registryValue('stats.prometheus_file'))
+        except EnvironmentError:
+            self.log.exception('Tell: could not write the Prometheus file')
+
+    # Periodic incremental sync, see sync_interval
+    def sync_tells(self):
+        try:
+            self.queryTell.sync_unread()
+        except Exception:
+            self.log.exception('Tell: periodic sync failed')
+
+    def telllog(self, irc, msg, args, opts, words):
+        """[--since <when>] [--until <when>] [--sent|--received] [--before <cursor>] [<words>]
+
+        Tells you sent or received, newest first, optionally only those with all of <words> in
+        them. <when> is a date like 2017-05-01 or a duration back from now like 2d. The last line
+        has the command for the next page. Private tells are only listed when you are identified
+        to the bot as the user named like your nick.
+        """
+        self.search_log(irc, msg, 'telllog', opts, words)
+
+    telllog = wrap(telllog, [getopts({'since': 'something', 'until': 'something', 'sent': '', 'received': '',
+                                      'before': 'something'}), optional('text')])
+
+    def tellsearch(self, irc, msg, args, opts, words):
+        """[--since <when>] [--until <when>] [--sent|--received] [--before <cursor>] <words>
+
+        Tells you sent or received with all of <words> in them, newest first. See telllog.
+        """
+        self.search_log(irc, msg, 'tellsearch', opts, words)
+
+    tellsearch = wrap(tellsearch, [getopts({'since': 'something', 'until': 'something', 'sent': '', 'received': '',
+                                            'before': 'something'}), 'text'])
+
+    # One page of the sender's history as NOTICEs, with the command for the next page after it
+    def search_log(self, irc, msg, command, opts, words):
+        _opts = dict(opts)
+        try:
+            _since = parse_when(_opts['since'], past=True) if 'since' in _opts else None
+            _until = parse_when(_opts['until'], past=True) if 'until' in _opts else None
+            _before = self.parse_cursor(_opts['before']) if 'before' in _opts else None
+        except ValueError as e:
+            irc.error(str(e))
+            return
+        _direction = 'sent' if 'sent' in _opts else 'received' if 'received' in _opts else None
+
+        _size = self.registryValue('search.page_size')
+        _rows = TellDB.search_tells(msg.nick, words.split() if words else None, _since, _until, _direction,
+                                    _before, _size + 1, private=self.owns_nick(msg))
+        if not _rows:
+            irc.queueMsg(ircmsgs.notice(msg.nick, 'No tells found.'))
+            return
+
+        _items = ['%s %s -> %s: %s' % (r.Timestamp.strftime('%Y-%m-%d %H:%M'), r.FromNick, r.ToNick, r.Content)
+                  for r in _rows[:_size]]
+        if len(_rows) > _size:
+            # Everything but --before, which moves on to after the last row shown
+            _next = [command] + ['--' + k if v is True else '--%s %s' % (k, v) for k, v in opts if k != 'before']
+            _last = _rows[_size - 1]
+            _next.append('--before %s,%d' % (_last.Timestamp.isoformat(), _last.ID))
+            if words:
+                _next.append(words)
+            _items.append('more: ' + ' '.join(_next))
+
+        for line in pack_lines(_items, self.notice_budget(irc, msg.nick), ' | '):
+            irc.queueMsg(ircmsgs.notice(msg.nick, line))
+
+    # Whether msg comes from the bot user named like the nick it uses. Anyone can take a nick, so
+    # only that user gets to see the nick's private tells.
+    @staticmethod
+    def owns_nick(msg):
+        try:
+            _user = ircdb.users.getUser(msg.prefix)
+        except KeyError:
+            return False
+        return TellDB.nick_key(_user.name) == TellDB.nick_key(msg.nick)
+
+    # (Timestamp, ID) of a --before cursor
+    @staticmethod
+    def parse_cursor(text):
+        try:
+            _when, _id = text.rsplit(',', 1)
+            return datetime.datetime.fromisoformat(_when), int(_id)
+        except ValueError:
+            raise ValueError('not a telllog cursor: %s' % text)
 
     def delay_tells(self, irc, msg, args, time):
         """
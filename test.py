@@ -28,8 +28,41 @@
 
 ###
 
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import inspect, select, text
+
 from supybot.test import *
 import supybot.conf as conf
+import supybot.ircdb as ircdb
+import supybot.ircmsgs as ircmsgs
+import supybot.schedule as schedule
+
+from .local import tell_db
+from .local.tell_cache import to_epoch
+from .local.tell_db import TellDB
+from .local.tell_stats import STATS
+from .local.tell_writer import WriteBehindQueue
+
+
+# Stands in for the bot's Irc when deliver_tells is called directly, keeping what gets sent
+class FakeIrc(object):
+    nick = 'test'
+    prefix = 'test!tell@some.long.host.example.org'
+
+    def __init__(self):
+        self.sent = []
+
+    def queueMsg(self, m):
+        self.sent.append(m)
 
 
 class TellTestCase(PluginTestCase):
@@ -59,6 +92,312 @@ class TellTestCase(PluginTestCase):
         _pr = conf.supybot.plugins.tell.you_have_mail()
         assert(_pr is not None)
 
+    def testTellBacklog(self):
+        self.assertNotError('tell foo hello world')
+        self.assertNotError('tell foo hello again')
+        self.prefix = self._user1
+
+        _m = conf.supybot.plugins.tell.tell_message()
+        _pr = conf.supybot.plugins.tell.you_have_private_mail()
+        self.assertResponse("Hey hows it going", _pr.format(**{'to': 'foo', 'priv_count': 2, 'plural': 's'}), to="#test_channel")
+        self.assertResponse(" ", _m.format(**{"time_ago": "now", "from": "bar", "content": "hello world"}), to="#test_channel")
+        self.assertResponse(" ", _m.format(**{"time_ago": "now", "from": "bar", "content": "hello again"}), to="#test_channel")
+
+        # Whole backlog was flagged read, nothing left to relay
+        self.assertNoResponse(" ", to="#test_channel")
+
+    def testTellNickCase(self):
+        self.assertNotError('tell FOO^ hello world')
+        self.prefix = 'foo~!bar@baz'
+
+        _pr = conf.supybot.plugins.tell.you_have_private_mail()
+        self.assertResponse("Hey hows it going", _pr.format(**{'to': 'foo~', 'priv_count': 1, 'plural': ''}), to="#test_channel")
+        self.assertNotError(" ", to="#test_channel")
+        self.assertNoResponse(" ", to="#test_channel")
+
+    def testTellMultipleNicks(self):
+        self.assertNotError('tell foo,baz hello everyone')
+        _pr = conf.supybot.plugins.tell.you_have_private_mail()
+
+        self.prefix = self._user1
+        self.assertResponse("Hey hows it going", _pr.format(**{'to': 'foo', 'priv_count': 1, 'plural': ''}), to="#test_channel")
+        self.assertNotError(" ", to="#test_channel")
+
+        self.prefix = 'baz!baz@baz'
+        self.assertResponse("Hey hows it going", _pr.format(**{'to': 'baz', 'priv_count': 1, 'plural': ''}), to="#test_channel")
+        self.assertNotError(" ", to="#test_channel")
+        self.assertNoResponse(" ", to="#test_channel")
+
+    def testInsertTellsSameSecond(self):
+        # Timestamps like MySQL's DATETIME keeps them, and two identical sends within that second
+        _now = datetime.datetime.now().replace(microsecond=0)
+        _first = TellDB.insert_tells('bar', ['twice', 'Twice2'], 'same text', False, _now)
+        _second = TellDB.insert_tells('bar', ['twice', 'Twice2'], 'same text', False, _now)
+        self.assertEqual(len(set(_first + _second)), 4)
+        _rows = dict((r.ID, r.ToNick) for r in TellDB.stream_unread() if r.ID in _first + _second)
+        self.assertEqual([_rows[i] for i in _first], ['twice', 'Twice2'])
+        self.assertEqual([_rows[i] for i in _second], ['twice', 'Twice2'])
+        TellDB.update_read_many(_first + _second)
+
+    def testWriteBehind(self):
+        TellDB.start_write_behind(10, 5, 0.05)
+        try:
+            self.assertNotError('tell foo hello world')
+            self.prefix = self._user1
+
+            _pr = conf.supybot.plugins.tell.you_have_private_mail()
+            self.assertResponse("Hey hows it going", _pr.format(**{'to': 'foo', 'priv_count': 1, 'plural': ''}), to="#test_channel")
+            self.assertNotError(" ", to="#test_channel")
+
+            # Both the insert and the read flag made it to the DB
+            TellDB.flush()
+            self.assertEqual([r for r in TellDB.stream_unread() if r.ToNick == 'foo'], [])
+        finally:
+            TellDB.stop_write_behind()
+
+    def testWriteBehindLookup(self):
+        # Long enough that nothing gets flushed while we look
+        TellDB.start_write_behind(10, 100, 30)
+        try:
+            _id, = TellDB.insert_tells('bar', ['queued'], 'hello world', False, datetime.datetime.now())
+            _start = time.time()
+            self.assertEqual([(r.ID, r.Content) for r in TellDB.query_unread_for('Queued')], [(_id, 'hello world')])
+            self.assertEqual([r.ID for r in TellDB.query_unread_for_many(['queued', 'other'])], [_id])
+            # Merged in from the queue rather than waiting on it
+            self.assertLess(time.time() - _start, 5)
+            _t = tell_db.TellRecord.__table__
+            with tell_db.get_engine().connect() as conn:
+                self.assertIsNone(conn.execute(select(_t.c.ID).where(_t.c.ID == _id)).scalar())
+
+            TellDB.update_read_many([_id])
+            self.assertEqual(TellDB.query_unread_for('queued'), [])
+        finally:
+            TellDB.stop_write_behind()
+        self.assertEqual(TellDB.query_unread_for('queued'), [])
+
+    def testWriteBehindFailures(self):
+        _flushed = []
+        _dropped = []
+
+        def flush(ops):
+            if ('insert', 'bad') in ops:
+                raise ValueError('bad op')
+            _flushed.extend(ops)
+
+        _writer = WriteBehindQueue(flush, queue_size=10, batch_size=5, interval=0.01, max_attempts=2,
+                                  dropped=_dropped.extend)
+        try:
+            for payload in ('a', 'bad', 'b'):
+                _writer.put('insert', payload)
+            # The bad op doesn't hold back the others, and join returns once it has been dropped
+            _writer.join()
+            self.assertEqual(_flushed, [('insert', 'a'), ('insert', 'b')])
+            self.assertEqual(_dropped, [('insert', 'bad')])
+            self.assertEqual(_writer._pending, [])
+        finally:
+            _writer.stop()
+
+    def testLazyLoad(self):
+        _lib = self.irc.getCallback('Tell').queryTell
+        _lib.configure_cache(True, 10, 10)
+        _lib.load_unread()
+        try:
+            # Clear out anything left over in the DB from other tests
+            self.prefix = self._user1
+            self.assertNotError('skiptells')
+
+            self.prefix = self._user2
+            self.assertNotError('tell foo hello world')
+            self.assertNotIn('foo', _lib.unread_tells)
+
+            self.prefix = self._user1
+            _pr = conf.supybot.plugins.tell.you_have_private_mail()
+            self.assertResponse("Hey hows it going", _pr.format(**{'to': 'foo', 'priv_count': 1, 'plural': ''}), to="#test_channel")
+            self.assertNotError(" ", to="#test_channel")
+
+            # Delivered, so foo is now known to have no mail
+            self.assertIn('foo', _lib.no_tells)
+            self.assertNoResponse(" ", to="#test_channel")
+        finally:
+            _lib.configure_cache(False, 10, 10)
+            _lib.load_unread()
+
+    def testToEpoch(self):
+        # Down to the microsecond, or a tell sent just now may already read as a second ago
+        _now = time.time()
+        self.assertAlmostEqual(to_epoch(datetime.datetime.fromtimestamp(_now)), _now, places=5)
+
+    def testThreadedInserts(self):
+        _ids = []
+
+        def insert(n):
+            try:
+                for i in range(10):
+                    _ids.extend(TellDB.insert_tells('bar', ['threaded%d' % n], 'hello %d' % i, False,
+                                                    datetime.datetime.now()))
+            finally:
+                TellDB.end_session()
+
+        _threads = [threading.Thread(target=insert, args=(n,)) for n in range(4)]
+        for t in _threads:
+            t.start()
+        for t in _threads:
+            t.join()
+
+        # Every thread had a session of its own, so no insert got lost or handed out twice
+        self.assertEqual(len(set(_ids)), 40)
+        TellDB.update_read_many(_ids)
+
+    def testInsertDuringRefresh(self):
+        _lib = self.irc.getCallback('Tell').queryTell
+        _stored = threading.Event()
+
+        def refresh():
+            with _lib._refresh_lock:
+                # The insert reaches the DB while a refresh holds the lock, and the load reads it
+                _stored.wait(5)
+                _lib.load_unread()
+
+        _refresher = threading.Thread(target=refresh)
+        _refresher.start()
+        try:
+            _inserter = threading.Thread(target=_lib.insert_tells,
+                                         args=('bar', ['refreshed'], 'hello world', False, datetime.datetime.now()))
+            _inserter.start()
+            _deadline = time.time() + 5
+            while not _stored.is_set() and time.time() < _deadline:
+                if any(r.ToNick == 'refreshed' for r in TellDB.stream_unread()):
+                    _stored.set()
+                time.sleep(0.01)
+            self.assertTrue(_stored.is_set())
+
+            # Cached once, by the load, not again by the insert
+            self.assertEqual(_lib.get_user_tell_count('refreshed'), 1)
+        finally:
+            _stored.set()
+            _refresher.join()
+            _inserter.join()
+            TellDB.update_read_many([r.ID for r in TellDB.stream_unread() if r.ToNick == 'refreshed'])
+            _lib.load_unread()
+
+    def testConcurrentDelivery(self):
+        _cb = self.irc.getCallback('Tell')
+        _cb.queryTell.insert_tells('bar', ['racer'], 'hello world', False, datetime.datetime.now())
+
+        _irc = FakeIrc()
+
+        _msg = ircmsgs.privmsg('#test', 'hi', prefix='racer!bar@baz')
+        _threads = [threading.Thread(target=_cb.deliver_tells, args=(_irc, _msg, '#test')) for _ in range(8)]
+        for t in _threads:
+            t.start()
+        for t in _threads:
+            t.join()
+
+        # Header plus the one tell, delivered exactly once
+        self.assertEqual(len(_irc.sent), 2)
+
+    def testTemplates(self):
+        _m = conf.supybot.plugins.tell.tell_message
+        _original = _m()
+        try:
+            # Bad templates are refused when they're set
+            self.assertError('config plugins.Tell.tell_message {nope} from {from}')
+            self.assertError('config plugins.Tell.tell_message {from')
+            self.assertEqual(_m(), _original)
+
+            # and good ones take effect right away
+            self.assertNotError('config plugins.Tell.tell_message {from} said {content}')
+            self.assertNotError('tell foo hello world')
+            self.prefix = self._user1
+            self.assertNotError("Hey hows it going", to="#test_channel")
+            self.assertResponse(" ", "bar said hello world", to="#test_channel")
+        finally:
+            _m.setValue(_original)
+
+    def testPackNotices(self):
+        _cb = self.irc.getCallback('Tell')
+        _rand = random.Random(4)
+        _contents = ['%d %s' % (i, ' '.join(['w\u00e9rd' * _rand.randint(1, 4)] * _rand.randint(1, 20)))
+                     for i in range(40)]
+        # A couple that need splitting, one of them without any spaces
+        _contents += ['long ' + 'x\u00e9 ' * 400, 'y' * 900]
+        for c in _contents:
+            _cb.queryTell.insert_tells('bar', ['packer'], c, False, datetime.datetime.now())
+
+        _irc = FakeIrc()
+
+        conf.supybot.plugins.tell.pack_notices.setValue(True)
+        try:
+            _cb.deliver_tells(_irc, ircmsgs.privmsg('#test', 'hi', prefix='packer!bar@baz'), '#test')
+        finally:
+            conf.supybot.plugins.tell.pack_notices.setValue(False)
+
+        # Fewer lines than tells, none over the limit as relayed by the server, nothing lost
+        self.assertTrue(1 < len(_irc.sent) < len(_contents))
+        for m in _irc.sent:
+            _line = str(ircmsgs.IrcMsg(prefix=FakeIrc.prefix, msg=m))
+            self.assertTrue(len(_line.encode('utf-8')) <= 512, _line)
+        _squash = lambda text: ''.join(text.replace(' | ', '').split())
+        _text = _squash(''.join(m.args[1] for m in _irc.sent))
+        for c in _contents:
+            self.assertIn(_squash(c), _text)
+
+    def testMoreTells(self):
+        _cb = self.irc.getCallback('Tell')
+        self.prefix = self._user1
+        self.assertNotError('skiptells')
+
+        self.prefix = self._user2
+        for i in range(3):
+            self.assertNotError('tell foo hello %d' % i)
+
+        conf.supybot.plugins.tell.delivery.max_per_activation.setValue(2)
+        try:
+            self.prefix = self._user1
+            _pr = conf.supybot.plugins.tell.you_have_private_mail()
+            self.assertResponse("Hey hows it going", _pr.format(**{'to': 'foo', 'priv_count': 2, 'plural': 's'}), to="#test_channel")
+            self.assertResponse(" ", "now from bar: hello 0", to="#test_channel")
+            self.assertResponse(" ", "now from bar: hello 1", to="#test_channel")
+            _more = conf.supybot.plugins.tell.more_tells()
+            self.assertResponse(" ", _more.format(**{'count': 1, 'plural': ''}), to="#test_channel")
+
+            # Only the delivered page was flagged read, the rest waits for moretells
+            self.assertEqual([r.Content for r in TellDB.stream_unread() if r.ToNick == 'foo'], ['hello 2'])
+            self.assertNoResponse(" ", to="#test_channel")
+
+            self.assertResponse("moretells", _pr.format(**{'to': 'foo', 'priv_count': 1, 'plural': ''}))
+            self.assertEqual(self.irc.takeMsg().args[1], "now from bar: hello 2")
+            self.assertResponse("moretells", "No more tells.")
+            self.assertIsNone(_cb.queryTell.query_post('foo'))
+        finally:
+            conf.supybot.plugins.tell.delivery.max_per_activation.setValue(0)
+
+    def testPacedDelivery(self):
+        _cb = self.irc.getCallback('Tell')
+        for i in range(3):
+            _cb.queryTell.insert_tells('bar', ['paced'], 'hello %d' % i, False, datetime.datetime.now())
+
+        _irc = FakeIrc()
+
+        _cb.pacer.configure(1, 2)
+        try:
+            _cb.deliver_tells(_irc, ircmsgs.privmsg('#test', 'hi', prefix='paced!bar@baz'), '#test')
+        finally:
+            _cb.pacer.configure(0, 5)
+
+        # Header and one tell fit in the burst, the other two are scheduled and not yet read
+        self.assertEqual([m.args[1] for m in _irc.sent][1:], ['now from bar: hello 0'])
+        self.assertEqual(len(_cb._scheduled), 2)
+        self.assertEqual(len(_cb.queryTell.in_flight), 2)
+        self.assertEqual(len([r for r in TellDB.stream_unread() if r.ToNick == 'paced']), 2)
+        self.assertIsNone(_cb.queryTell.query_post('paced'))
+
+        for name in list(_cb._scheduled):
+            schedule.removeEvent(name)()
+        self.assertEqual(len(_irc.sent), 4)
+        self.assertEqual(_cb.queryTell.in_flight, set())
+        self.assertEqual([r for r in TellDB.stream_unread() if r.ToNick == 'paced'], [])
+
     def testSkipTells(self):
         self.prefix = self._user2
         # Save ourselves a tell first.
@@ -74,14 +413,62 @@ class TellTestCase(PluginTestCase):
         self.assertNoResponse(" ", to="#test_channel")
 
     def testDelayTells(self):
+        _lib = self.irc.getCallback('Tell').queryTell
         self.prefix = self._user2
         # Save ourselves a tell first.
         self.getMsg("tell foo hello world")
 
         self.prefix = self._user1
-        self.assertNotError("delaytells 1 hour")
+        try:
+            self.assertNotError("delaytells 1 hour")
+
+            # If we have no tells, delay worked.
+            self.assertNoResponse(" ", to="#test_channel")
+
+            # and it's kept in the DB, so a reload doesn't lift it
+            self.assertNotError("tellrefresh --full")
+            self.assertTrue(_lib.is_delayed('foo'))
+            self.assertNoResponse(" ", to="#test_channel")
+        finally:
+            _lib.set_delay('foo', None)
+        self.assertNotError(" ", to="#test_channel")
+
+    def testDelayWithoutTells(self):
+        _lib = self.irc.getCallback('Tell').queryTell
+        self.prefix = 'quiet!bar@baz'
+        self.assertNotError("delaytells 2 seconds")
+        self.assertTrue(_lib.is_delayed('quiet'))
 
-        # If we have no tells, delay worked.
+        # Mail coming in after the delay was set is held back as well
+        self.prefix = self._user2
+        self.assertNotError('tell quiet hello world')
+        self.prefix = 'quiet!bar@baz'
+        self.assertNoResponse(" ", to="#test_channel")
+
+        # The timeline lifts the delay once it runs out (the DB row is left to expire)
+        _lib.timeline.run(time.time() + 3)
+        self.assertFalse(_lib.is_delayed('quiet'))
+        _lib.set_delay('quiet', None)
+        self.assertNotError(" ", to="#test_channel")
+        self.assertNotError(" ", to="#test_channel")
+        self.assertNoResponse(" ", to="#test_channel")
+
+    def testTellAt(self):
+        _lib = self.irc.getCallback('Tell').queryTell
+        self.assertError('tell --at soon later hello world')
+        self.assertNotError('tell --at 1h later hello world')
+
+        # Not due yet, neither in memory nor after a reload
+        self.prefix = 'later!bar@baz'
+        self.assertNoResponse(" ", to="#test_channel")
+        self.assertNotError("tellrefresh --full")
+        self.assertEqual(len(_lib.timeline), 1)
+        self.assertNoResponse(" ", to="#test_channel")
+
+        _lib.timeline.run(time.time() + 3601)
+        _pr = conf.supybot.plugins.tell.you_have_private_mail()
+        self.assertResponse(" ", _pr.format(**{'to': 'later', 'priv_count': 1, 'plural': ''}), to="#test_channel")
+        self.assertNotError(" ", to="#test_channel")
         self.assertNoResponse(" ", to="#test_channel")
 
     def testTellRefresh(self):
@@ -89,4 +476,406 @@ class TellTestCase(PluginTestCase):
         assert(_m is not None)
         self.assertResponse("tellrefresh", _m.format(**{'count': 0}))
 
+    def testTellRefreshSync(self):
+        _m = conf.supybot.plugins.tell.tell_refresh()
+        # Written behind the bot's back, like another tool would
+        _ids = [TellDB.insert_tells('bar', ['synced'], 'hello %d' % i, False, datetime.datetime.now())[0]
+                for i in range(2)]
+        self.prefix = 'synced!bar@baz'
+        self.assertNoResponse(" ", to="#test_channel")
+
+        self.prefix = self._user2
+        self.assertResponse("tellrefresh", _m.format(**{'count': 2}))
+        # Nothing new the second time round
+        self.assertResponse("tellrefresh", _m.format(**{'count': 0}))
+
+        # One of them flagged read elsewhere
+        TellDB.update_read_many(_ids[:1])
+        self.assertResponse("tellrefresh", _m.format(**{'count': 1}))
+
+        self.prefix = 'synced!bar@baz'
+        _pr = conf.supybot.plugins.tell.you_have_mail()
+        self.assertResponse(" ", _pr.format(**{'to': 'synced', 'pub_count': 1, 'plural': ''}), to="#test_channel")
+        self.assertResponse(" ", "now from bar: hello 1", to="#test_channel")
+        self.assertNoResponse(" ", to="#test_channel")
+
+    def testTellRefreshSyncNoKeys(self):
+        _lib = self.irc.getCallback('Tell').queryTell
+        _lib.configure_cache(True, 100, 100)
+        _lib.load_unread()
+        try:
+            # A tool that doesn't know about the key columns
+            _t = tell_db.TellRecord.__table__
+            _now = datetime.datetime.now()
+            with tell_db.get_engine().begin() as conn:
+                _id = conn.execute(_t.insert().values(FromNick='ToolUser', ToNick='Keyless', Content='from a tool',
+                                                      Private=False, Read=False, Timestamp=_now,
+                                                      Modified=_now)).inserted_primary_key[0]
+            self.assertEqual(_lib.sync_unread(), 1)
+            self.assertEqual([t.id for t in _lib.query_post('keyless').tells], [_id])
+            self.assertEqual([r.ID for r in TellDB.search_tells('tooluser', direction='sent')], [_id])
+            TellDB.update_read_many([_id])
+        finally:
+            _lib.configure_cache(False, 10000, 100000)
+            _lib.load_unread()
+
+    def testSharedClaim(self):
+        _ids = TellDB.insert_tells('bar', ['claimed'] * 40, 'hello world', False, datetime.datetime.now())
+
+        # Several bots on one SQLite file, all going for the same tells at once
+        _script = ('import json, sys; sys.path.insert(0, sys.argv[1]); from local.tell_db import TellDB; '
+                   'TellDB.configure_shared(sys.argv[2]); print(json.dumps(TellDB.claim_tells(json.loads(sys.argv[3]))))')
+        _procs = [subprocess.Popen([sys.executable, '-c', _script, os.path.dirname(os.path.abspath(__file__)),
+                                    'bot%d' % n, json.dumps(_ids)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                  for n in range(4)]
+        # Importing the plugin's modules pulls in supybot.world, which logs its shutdown on stdout
+        _claims = [json.loads([line for line in p.communicate()[0].decode().splitlines() if line.startswith('[')][-1])
+                   for p in _procs]
+
+        # Every tell went to exactly one of them
+        self.assertEqual(sorted(i for c in _claims for i in c), sorted(_ids))
+        self.assertEqual(TellDB.claim_tells(_ids), [])
+
+    def testSharedDelivery(self):
+        _lib = self.irc.getCallback('Tell').queryTell
+        _lib.configure_shared(True)
+        _lib.load_unread()
+        _instance = TellDB.instance
+        try:
+            # Another bot takes a tell
+            TellDB.configure_shared('other')
+            _ids = TellDB.insert_tells('bar', ['roamer'], 'hello world', False, datetime.datetime.now())
+            TellDB.configure_shared(_instance)
+            self.assertEqual(_lib.sync_unread(), 1)
+            self.assertTrue(_lib.has_mail('roamer'))
+
+            # and relays it before we get to
+            TellDB.configure_shared('other')
+            self.assertEqual(TellDB.claim_tells(_ids), _ids)
+            TellDB.configure_shared(_instance)
+            self.prefix = 'roamer!bar@baz'
+            self.assertNoResponse(" ", to="#test_channel")
+            self.assertFalse(_lib.has_mail('roamer'))
+
+            # Our own tells are claimed as they go out
+            self.prefix = self._user2
+            self.assertNotError('tell roamer hello again')
+            self.prefix = 'roamer!bar@baz'
+            self.assertNotError(" ", to="#test_channel")
+            self.assertResponse(" ", "now from bar: hello again", to="#test_channel")
+            self.assertEqual([r for r in TellDB.stream_unread() if r.ToNick == 'roamer'], [])
+
+            # A paced send dropped on unload hands its claimed tells back
+            _cb = self.irc.getCallback('Tell')
+            _lib.insert_tells('bar', ['roamer'] * 3, 'hello later', False, datetime.datetime.now())
+            _ids = sorted(r.ID for r in TellDB.stream_unread() if r.ToNick == 'roamer')
+            _cb.pacer.configure(1, 2)
+            try:
+                _cb.deliver_tells(FakeIrc(), ircmsgs.privmsg('#test', 'hi', prefix='roamer!bar@baz'), '#test')
+            finally:
+                _cb.pacer.configure(0, 5)
+            self.assertEqual(len(_lib.in_flight), 2)
+            self.assertEqual([r for r in TellDB.stream_unread() if r.ToNick == 'roamer'], [])
+            for name in list(_cb._scheduled):
+                schedule.removeEvent(name)
+            _lib.release_in_flight()
+            self.assertEqual(sorted(r.ID for r in TellDB.stream_unread() if r.ToNick == 'roamer'), _ids[1:])
+            TellDB.update_read_many(_ids)
+        finally:
+            _lib.configure_shared(False)
+            _lib.load_unread()
+
+    def testSharedTimedSync(self):
+        _lib = self.irc.getCallback('Tell').queryTell
+        _lib.configure_shared(True)
+        _lib.load_unread()
+        _instance = TellDB.instance
+        _scheduled = len(_lib.timeline)
+        TellDB.configure_shared('other')
+        _now = datetime.datetime.now()
+        _ids = TellDB.insert_tells('bar', ['planner'], 'see you later', False, _now, _now + datetime.timedelta(hours=1))
+        TellDB.configure_shared(_instance)
+        try:
+            # The change log overlap reads it again on every sync, it goes on the timeline once
+            for _ in range(3):
+                _lib.sync_unread()
+            self.assertEqual(len(_lib.timeline), _scheduled + 1)
+        finally:
+            TellDB.update_read_many(_ids)
+            _lib.configure_shared(False)
+            _lib.load_unread()
+
+    def testTellPurge(self):
+        _now = datetime.datetime.now()
+        _ids = TellDB.insert_tells('bar', ['purged'] * 3, 'hello world', False, _now)
+        TellDB.update_read_many(_ids[:2])
+        _t = tell_db.TellRecord.__table__
+        with tell_db.get_engine().begin() as conn:
+            conn.execute(_t.update().where(_t.c.ID.in_(_ids[:2])).values(Modified=_now - datetime.timedelta(days=10)))
+
+        self.assertError('tellpurge')
+        self.assertRegexp('tellpurge --archive --compact 5', r'^Purged 2 read tells older than 5 days in [0-9.]+s, '
+                                                               r'compacted in [0-9.]+s\.$')
+
+        # Only the old read ones went, into the archive
+        _a = tell_db.TellArchive.__table__
+        with tell_db.get_engine().connect() as conn:
+            self.assertEqual([r[0] for r in conn.execute(select(_t.c.ID).where(_t.c.ID.in_(_ids)))], _ids[2:])
+            self.assertEqual(sorted(r[0] for r in conn.execute(select(_a.c.ID).where(_a.c.ID.in_(_ids)))), _ids[:2])
+
+        # The newest row stays however old, or SQLite would hand its ID out again
+        TellDB.update_read_many(_ids[2:])
+        with tell_db.get_engine().begin() as conn:
+            conn.execute(_t.update().where(_t.c.ID.in_(_ids[2:])).values(Modified=_now - datetime.timedelta(days=10)))
+        TellDB.purge_read(_now)
+        with tell_db.get_engine().connect() as conn:
+            self.assertEqual([r[0] for r in conn.execute(select(_t.c.ID).where(_t.c.ID.in_(_ids)))], _ids[2:])
+
+    def testNormalize(self):
+        _t = tell_db.TellRecord.__table__
+        _msg = tell_db.TellMessage.__table__
+        _now = datetime.datetime.now()
+        # Written before normalize was set, moved over by normalize_tells
+        _old = TellDB.insert_tells('bar', ['norm1', 'norm2'], 'old news', False, _now)
+        TellDB.configure_normalize(True)
+        try:
+            # Rows other tests or an earlier run left behind may be moved over too, only ours are
+            # checked below
+            self.assertGreaterEqual(TellDB.normalize_tells(), 2)
+            self.assertGreaterEqual(TellDB.normalized_id, max(_old))
+            _new = TellDB.insert_tells('bar', ['norm1', 'norm2'], 'hello world', False, _now)
+            # Only rows past the mark are looked at again, and these were stored normalized
+            self.assertEqual(TellDB.normalize_tells(), 0)
+            self.assertGreaterEqual(TellDB.normalized_id, max(_new))
+        finally:
+            TellDB.configure_normalize(False)
+
+        with tell_db.get_engine().connect() as conn:
+            _rows = conn.execute(select(_t.c.Content, _t.c.MessageID).where(_t.c.ID.in_(_old + _new))).fetchall()
+            self.assertEqual(set(r.Content for r in _rows), {''})
+            self.assertEqual(len(set(r.MessageID for r in _rows)), 2)
+        self.assertEqual(sorted(r.Content for r in TellDB.stream_unread() if r.ID in _old + _new),
+                         ['hello world', 'hello world', 'old news', 'old news'])
+
+        # Still found by their text after it moved, however the index is kept
+        _found = TellDB.search_tells('norm1', ['old', 'news'], direction='received')
+        self.assertEqual([r.ID for r in _found if r.ID in _old], _old[:1])
+
+        # Recipients share the text in the cache too
+        self.assertNotError('tellrefresh --full')
+        _lib = self.irc.getCallback('Tell').queryTell
+        _cached = dict((t.id, t.content) for nick in ('norm1', 'norm2') for t in _lib.query_post(nick).tells)
+        self.assertIs(_cached[_new[0]], _cached[_new[1]])
+
+        # Purging the last row of a message drops the message. A newer tell keeps purge_read from
+        # having to leave one of ours as the newest row.
+        TellDB.update_read_many(_old + _new)
+        _newest = TellDB.insert_tells('bar', ['norm3'], 'newest', False, _now)
+        TellDB.purge_read(datetime.datetime.now() + datetime.timedelta(seconds=1), archive=True)
+        with tell_db.get_engine().connect() as conn:
+            _ids = set(r.MessageID for r in _rows)
+            self.assertEqual(conn.execute(select(_msg.c.ID).where(_msg.c.ID.in_(_ids))).fetchall(), [])
+            _archive = tell_db.TellArchive.__table__
+            self.assertEqual(sorted(r[0] for r in conn.execute(select(_archive.c.Content)
+                                                               .where(_archive.c.ID.in_(_old + _new)))),
+                             ['hello world', 'hello world', 'old news', 'old news'])
+            # The contentless FTS5 table was told the text each purged row had, or it would still
+            # match them
+            if inspect(conn).has_table('tell_fts'):
+                _matched = [r[0] for r in conn.execute(text(
+                    "SELECT rowid FROM tell_fts WHERE tell_fts MATCH '\"news\" OR \"world\"'"))]
+                self.assertEqual(set(_matched) & set(_old + _new), set())
+        TellDB.update_read_many(_newest)
+        self.assertNotError('tellrefresh --full')
+
+    def testJoinDelivery(self):
+        self.assertNotError('tell joiner psst')
+        self.irc.getCallback('Tell').queryTell.insert_tells('bar', ['joiner'], 'hello world', False,
+                                                            datetime.datetime.now())
+        conf.supybot.plugins.tell.delivery.on_join.setValue(True)
+        try:
+            self.irc.feedMsg(ircmsgs.join('#test_channel', prefix='joiner!bar@baz'))
+        finally:
+            conf.supybot.plugins.tell.delivery.on_join.setValue(False)
+
+        # Only the private one, the public one waits until they speak
+        _pr = conf.supybot.plugins.tell.you_have_private_mail()
+        _m = self.irc.takeMsg()
+        self.assertEqual((_m.command, _m.args), ('NOTICE', ('joiner', _pr.format(to='joiner', priv_count=1, plural=''))))
+        self.assertEqual(self.irc.takeMsg().args, ('joiner', 'now from bar: psst'))
+        self.assertIsNone(self.irc.takeMsg())
+
+        self.prefix = 'joiner!bar@baz'
+        self.assertNotError(" ", to="#test_channel")
+        self.assertResponse(" ", "now from bar: hello world", to="#test_channel")
+        self.assertNoResponse(" ", to="#test_channel")
+
+    def testPrefetch(self):
+        _cb = self.irc.getCallback('Tell')
+        _lib = _cb.queryTell
+        _lib.configure_cache(True, 100, 100)
+        _lib.load_unread()
+        try:
+            _ids = TellDB.insert_tells('bar', ['split1', 'split2'], 'hello world', False, datetime.datetime.now())
+            _queries = STATS.histogram('db.query_unread_for_many').count
+
+            # A netsplit coming back: the joins queue up for a single lookup
+            conf.supybot.plugins.tell.lazy_load.prefetch_delay.setValue(3600)
+            try:
+                for nick in ('split1', 'split2', 'split3'):
+                    self.irc.feedMsg(ircmsgs.join('#test_channel', prefix='%s!bar@baz' % nick))
+                self.irc.feedMsg(ircmsgs.nick('Split1', prefix='split1!bar@baz'))
+            finally:
+                conf.supybot.plugins.tell.lazy_load.prefetch_delay.setValue(0.5)
+            self.assertEqual(sorted(_cb._prefetch_queue), ['Split1', 'split1', 'split2', 'split3'])
+
+            schedule.removeEvent('Tell.prefetch')
+            _cb.run_prefetch()
+            for t in threading.enumerate():
+                if t.name == 'Tell prefetch':
+                    t.join()
+            self.assertEqual(STATS.histogram('db.query_unread_for_many').count, _queries + 1)
+            self.assertEqual(len(_lib.unread_tells['split1'].tells), 1)
+            self.assertEqual(len(_lib.unread_tells['split2'].tells), 1)
+            self.assertIn('split3', _lib.no_tells)
+
+            self.prefix = 'split2!bar@baz'
+            self.assertNotError(" ", to="#test_channel")
+            self.assertResponse(" ", "now from bar: hello world", to="#test_channel")
+            TellDB.update_read_many(_ids[:1])
+
+            # A tell sent while the prefetch query runs isn't hidden by the rows it read
+            _query = TellDB.query_unread_for_many
+
+            def query_then_tell(nicks, *args):
+                _rows = _query(nicks, *args)
+                _lib.insert_tells('bar', ['split4'], 'sent meanwhile', False, datetime.datetime.now())
+                return _rows
+
+            TellDB.query_unread_for_many = staticmethod(query_then_tell)
+            try:
+                self.assertEqual(_lib.prefetch(['split4']), 1)
+            finally:
+                TellDB.query_unread_for_many = staticmethod(_query)
+            self.assertNotIn('split4', _lib.no_tells)
+            self.assertEqual([t.content for t in _lib.query_post('split4').tells], ['sent meanwhile'])
+            TellDB.update_read_many([t.id for t in _lib.query_post('split4').tells])
+        finally:
+            _lib.configure_cache(False, 10000, 100000)
+            _lib.load_unread()
+
+    def testTellLog(self):
+        with tell_db.get_engine().connect() as conn:
+            self.assertTrue(inspect(conn).has_table('tell_fts'))
+
+        _start = datetime.datetime(2030, 1, 1, 12, 0)
+        _mine = []
+        for i in range(5):
+            _mine += TellDB.insert_tells('logger', ['logged'], 'meeting number %d' % i, False,
+                                         _start + datetime.timedelta(days=i))
+        _mine += TellDB.insert_tells('logged', ['logger'], 'no meeting today', False,
+                                     _start + datetime.timedelta(days=5))
+        _mine += TellDB.insert_tells('logger', ['other'], 'lunch', False, _start)
+        _ids = [r.ID for r in TellDB.search_tells('logger', limit=100)]
+        self.assertEqual(sorted(_ids), sorted(_mine))
+
+        self.prefix = 'logger!bar@baz'
+        conf.supybot.plugins.tell.search.page_size.setValue(2)
+        try:
+            self.assertResponse('tellsearch meeting', '2030-01-06 12:00 logged -> logger: no meeting today | '
+                                                      '2030-01-05 12:00 logger -> logged: meeting number 4 | '
+                                                      'more: tellsearch --before 2030-01-05T12:00:00,%d meeting'
+                                % _ids[1])
+            self.assertResponse('tellsearch --before 2030-01-05T12:00:00,%d meeting' % _ids[1],
+                                '2030-01-04 12:00 logger -> logged: meeting number 3 | '
+                                '2030-01-03 12:00 logger -> logged: meeting number 2 | '
+                                'more: tellsearch --before 2030-01-03T12:00:00,%d meeting' % _ids[3])
+            self.assertResponse('telllog --sent --since 2030-01-04 --until 2030-01-05 meeting',
+                                '2030-01-04 12:00 logger -> logged: meeting number 3')
+            self.assertResponse('tellsearch number "4"', '2030-01-05 12:00 logger -> logged: meeting number 4')
+            self.assertResponse('tellsearch --received today', '2030-01-06 12:00 logged -> logger: no meeting today')
+            self.assertResponse('tellsearch lunch meeting', 'No tells found.')
+            self.assertError('telllog --before yesterday')
+        finally:
+            conf.supybot.plugins.tell.search.page_size.setValue(10)
+            # Gone rather than read, the history of a rerun against the same database starts empty
+            _t = tell_db.TellRecord.__table__
+            with tell_db.get_engine().begin() as conn:
+                conn.execute(_t.delete().where(_t.c.ID.in_(_mine)))
+
+    def testTellLogPrivate(self):
+        _start = datetime.datetime(2030, 2, 1, 12, 0)
+        _mine = TellDB.insert_tells('keeper', ['secretive'], 'the code is 1234', True, _start)
+        _mine += TellDB.insert_tells('Keeper', ['secretive'], 'lunch at noon', False,
+                                     _start + datetime.timedelta(minutes=1))
+        try:
+            # Anyone can take the nick, they only get the public tells
+            self.prefix = 'secretive!impostor@elsewhere'
+            self.assertResponse('telllog', '2030-02-01 12:01 Keeper -> secretive: lunch at noon')
+
+            _user = ircdb.users.newUser()
+            _user.name = 'secretive'
+            _user.addHostmask('secretive!owner@home')
+            ircdb.users.setUser(_user)
+            try:
+                self.prefix = 'secretive!owner@home'
+                self.assertResponse('telllog', '2030-02-01 12:01 Keeper -> secretive: lunch at noon | '
+                                               '2030-02-01 12:00 keeper -> secretive: the code is 1234')
+            finally:
+                ircdb.users.delUser(_user.id)
+
+            # Sent tells are found whatever case the sender's nick had
+            self.prefix = 'KEEPER!bar@baz'
+            self.assertResponse('telllog --sent', '2030-02-01 12:01 Keeper -> secretive: lunch at noon')
+        finally:
+            _t = tell_db.TellRecord.__table__
+            with tell_db.get_engine().begin() as conn:
+                conn.execute(_t.delete().where(_t.c.ID.in_(_mine)))
+
+    def testEngineReload(self):
+        _engine = tell_db.get_engine()
+        _cb = self.irc.getCallback('Tell')
+        _cb.queryTell.insert_tells('bar', ['reloaded'], 'hello world', False, datetime.datetime.now())
+
+        # The engine survives the reload, disposed in die() and reconnected on first use
+        self.assertNotError('reload Tell')
+        self.assertIs(tell_db.get_engine(), _engine)
+        self.prefix = 'reloaded!bar@baz'
+        self.assertNotError(" ", to="#test_channel")
+        self.assertResponse(" ", "now from bar: hello world", to="#test_channel")
+
+    def testTellStats(self):
+        _cb = self.irc.getCallback('Tell')
+        _pending = _cb.queryTell.get_tell_count()
+        self.assertNotError('tell foo,foo hello world')
+        # Kept up to date without a reload
+        self.assertEqual(_cb.queryTell.get_tell_count(), _pending + 2)
+        self.prefix = self._user1
+        self.assertNotError(" ", to="#test_channel")
+        self.assertNotError(" ", to="#test_channel")
+        self.assertNotError(" ", to="#test_channel")
+        self.assertEqual(_cb.queryTell.get_tell_count(), _pending)
+
+        _lines = [self.getMsg('tellstats').args[1]]
+        self.assertRegex(_lines[0], r'^delayed: \d+ \| in_flight: \d+ \| mailboxes: \d+ \| pending: %d' % _pending)
+        while True:
+            m = self.irc.takeMsg()
+            if m is None:
+                break
+            _lines.append(m.args[1])
+        self.assertIn('infilter: ', ' '.join(_lines))
+        self.assertIn('db.insert_tells: ', ' '.join(_lines))
+
+        _path = os.path.join(tempfile.mkdtemp(), 'tell.prom')
+        conf.supybot.plugins.tell.stats.prometheus_file.setValue(_path)
+        try:
+            _cb.write_prometheus()
+        finally:
+            conf.supybot.plugins.tell.stats.prometheus_file.setValue('')
+        with open(_path) as f:
+            _text = f.read()
+        self.assertIn('tell_pending %d\n' % _pending, _text)
+        self.assertIn('tell_latency_seconds_count{op="infilter"}', _text)
+        self.assertIn('tell_tells_inserted_total', _text)
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: